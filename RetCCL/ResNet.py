@@ -3,6 +3,7 @@ import torch.nn as nn
 from torch.hub import load_state_dict_from_url
 import torch.nn.functional as F
 from torch.nn import Parameter
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 __all__ = [
@@ -99,6 +100,16 @@ class BasicBlock(nn.Module):
 
         return out
 
+    def fuse_for_inference(self):
+        """Folds the (evaluation mode) batch norms into the convolutions"""
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.bn2)
+        self.bn2 = nn.Identity()
+        if self.downsample is not None:
+            self.downsample = fuse_conv_bn_eval(*self.downsample)
+        return self
+
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -152,6 +163,18 @@ class Bottleneck(nn.Module):
 
         return out
 
+    def fuse_for_inference(self):
+        """Folds the (evaluation mode) batch norms into the convolutions"""
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.bn2)
+        self.bn2 = nn.Identity()
+        self.conv3 = fuse_conv_bn_eval(self.conv3, self.bn3)
+        self.bn3 = nn.Identity()
+        if self.downsample is not None:
+            self.downsample = fuse_conv_bn_eval(*self.downsample)
+        return self
+
 
 class NormedLinear(nn.Module):
     def __init__(self, in_features, out_features):
@@ -191,6 +214,7 @@ class ResNet(nn.Module):
         self.inplanes = 64
         self.dilation = 1
         self.return_attn = return_attn
+        self.channels_last = False
         if replace_stride_with_dilation is None:
             # each element in the tuple indicates if we should replace
             # the 2x2 stride with a dilated convolution instead
@@ -326,7 +350,36 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def fuse_for_inference(self, channels_last=False):
+        """Prepares the model for (faster) inference
+
+        Folds all batch norms (including the downsampling branches') into the
+        convolutions before them.  The outputs match the unfused model's up to
+        floating point error.  Only valid in evaluation mode, as the batch
+        norms' running statistics are baked into the convolutions.
+
+        The ReLUs are left as they are (in-place, so they do not allocate),
+        as eager PyTorch has no generally available fused conv + ReLU kernels.
+
+        Args:
+            channels_last (bool): If True, the model is converted to (and run
+                in) channels last memory layout, which is a lot faster for
+                convolutions on most CPUs (and GPUs with tensor cores).
+        """
+        assert not self.training, "only models in evaluation mode can be fused"
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+        for module in self.modules():
+            if isinstance(module, (BasicBlock, Bottleneck)):
+                module.fuse_for_inference()
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        self.channels_last = channels_last
+        return self
+
     def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
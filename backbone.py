@@ -0,0 +1,96 @@
+"""Loading of the (fully convolutional) RetCCL feature extractor."""
+import sys
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from fov_cache import grey_to_rgb
+from greyscale import fold_greyscale_input
+
+# load base fully convolutional model (w/o pooling / flattening or head)
+# In this case we're loading the xiyue wang RetCLL model,
+# change this bit for other networks
+if (p := "./RetCCL") not in sys.path:
+    sys.path = [p] + sys.path
+import ResNet  # noqa: E402
+
+
+def to_tensor(image: np.ndarray) -> torch.Tensor:
+    """Turns an (height, width[, channels]) image into a (C, H, W) tensor.
+
+    Does the same as torchvision's `ToTensor` for numpy arrays (scaling
+    8-bit images to [0, 1]), without the seconds it takes to import
+    torchvision.
+    """
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    tensor = torch.from_numpy(image.transpose((2, 0, 1))).contiguous()
+    if tensor.dtype == torch.uint8:
+        return tensor.to(dtype=torch.get_default_dtype()).div(255)
+    return tensor
+
+
+def backbone_transforms(
+    *, greyscale: bool, mean: Sequence[float], std: Sequence[float]
+) -> Callable[[np.ndarray], torch.Tensor]:
+    """Transforms turning (parts of) a greyscale FOV into backbone inputs.
+
+    Args:
+        greyscale:  Whether the backbone takes single-channel inputs (see
+            `load_backbone`).
+    """
+    if greyscale:
+        # normalisation is folded into the backbone's first convolution
+        return to_tensor
+    mean_t = torch.tensor(mean).view(-1, 1, 1)
+    std_t = torch.tensor(std).view(-1, 1, 1)
+
+    def tfms(image: np.ndarray) -> torch.Tensor:
+        # From grey to 3-channel (tile by tile)
+        return to_tensor(grey_to_rgb(image)).sub_(mean_t).div_(std_t)
+
+    return tfms
+
+
+def load_backbone(
+    backbone_path: Path,
+    *,
+    greyscale: bool,
+    mean: Sequence[float],
+    std: Sequence[float],
+    device: torch.device,
+    int8_path: Optional[Path] = None,
+) -> nn.Module:
+    """Loads the RetCCL backbone, prepared for inference.
+
+    Args:
+        backbone_path:  The backbone's weights.
+        greyscale:  Whether to fold the normalisation and channel repetition
+            into the first convolution, so the backbone takes raw greyscale
+            images.
+        mean, std:  Normalisation the backbone was trained with.
+        int8_path:  Quantised version of the backbone to load (see
+            `quantization.quantize_backbone`).  Only runs on the CPU.
+    """
+    base_model = ResNet.resnet50(
+        num_classes=128, mlp=False, two_branch=False, normlinear=True
+    )
+    pretext_model = torch.load(backbone_path, map_location=device)
+    base_model.avgpool = nn.Identity()
+    base_model.flatten = nn.Identity()
+    base_model.fc = nn.Identity()
+    base_model.load_state_dict(pretext_model, strict=True)
+    # fold the batch norms into the convolutions and run in channels last
+    # layout, which is a lot faster and gives the same features (up to
+    # floating point error)
+    base_model = base_model.eval().fuse_for_inference(channels_last=True)
+    if greyscale:
+        base_model = fold_greyscale_input(base_model, mean, std)
+    if int8_path is not None:
+        from quantization import load_quantized_backbone
+        assert device.type == "cpu", "int8 backbones only run on the CPU"
+        base_model = load_quantized_backbone(base_model, int8_path)
+    return base_model.to(device)
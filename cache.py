@@ -0,0 +1,271 @@
+"""Content-addressed cache of FOVs and the features extracted from them.
+
+Each input is cached in a directory named after a hash of its content, so
+inputs with the same name in different places do not collide, while the
+same FOV is only processed once regardless of where it is read from.  The
+features within are keyed by a fingerprint of the backbone and
+preprocessing, so changing either never silently reuses stale features.
+
+A manifest (`manifest.json` in the cache directory) keeps track of the
+entries' sizes and last accesses, which allows enforcing a disk budget by
+evicting the least recently used entries.  It also memoizes the content
+hashes of inputs by their identity (location, size, modification time), so
+unchanged inputs do not have to be read (or downloaded) to find their entry.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+
+from fov_cache import has_fov, read_fov
+from locking import FileLock
+
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_digest(path: Path, *, block_size: int = 2**24) -> str:
+    """Calculates the hash of a file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fp:
+        while block := fp.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(obj: Any) -> str:
+    """Calculates a short hash of a JSON-serialisable object."""
+    return hashlib.blake2b(
+        json.dumps(obj, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+class CacheManifest:
+    """Manifest of a content-addressed cache directory.
+
+    Several processes can share a cache directory:  the manifest is only
+    modified under a lock (re-reading it first), entries in use are held with
+    a shared lock so other processes never evict them, and cache artifacts
+    are produced under a per-artifact lock (see `producing`), so they are
+    only produced once.
+
+    Args:
+        cache_dir:  Directory of the cache.
+        budget:  Disk space (in bytes) the cache entries may take up.  If
+            None, entries are never evicted.
+    """
+
+    def __init__(self, cache_dir: Path, budget: Optional[int] = None) -> None:
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.path = cache_dir / MANIFEST_NAME
+        self.lock_dir = cache_dir / "locks"
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.digests: Dict[str, str] = {}
+        # shared locks on the entries used by this process (and a lock
+        # guarding them, for runs preparing several slides in parallel)
+        self._held: Dict[str, FileLock] = {}
+        self._held_lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        if self.path.exists():
+            with open(self.path) as fp:
+                manifest = json.load(fp)
+            self.entries = manifest["entries"]
+            self.digests = manifest["digests"]
+
+    def save(self) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump({"entries": self.entries, "digests": self.digests}, fp)
+        tmp_path.replace(self.path)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # read-modify-write of the manifest, excluding other processes
+        with FileLock(self.lock_dir / f"{MANIFEST_NAME}.lock"):
+            self.load()
+            yield
+            self.save()
+
+    def known_digest(self, identity: str) -> Optional[str]:
+        """Returns the content hash of an input, if it is already known."""
+        return self.digests.get(identity)
+
+    def digest(self, identity: str, source: Union[Path, bytes]) -> str:
+        """Returns the content hash of an input, hashing it if necessary.
+
+        Args:
+            identity:  Identity of the input (see `sftp.source_identity`).
+            source:  Local copy of the input, or its content.
+        """
+        if (digest := self.known_digest(identity)) is None:
+            digest = (
+                file_digest(source) if isinstance(source, Path)
+                else hashlib.blake2b(source, digest_size=16).hexdigest()
+            )
+            with self._transaction():
+                self.digests[identity] = digest
+        return digest
+
+    def entry_dir(self, digest: str) -> Path:
+        return self.cache_dir / digest
+
+    def touch(self, digest: str, **info: Any) -> Path:
+        """Marks an entry as used, creating it if necessary.
+
+        The entry is protected from eviction by other processes until
+        `release` is called (or this process exits).
+
+        Args:
+            info:  Additional information to record about the entry (e.g.
+                the name / URL of the input).
+
+        Returns:
+            The entry's directory.
+        """
+        with self._held_lock:
+            if digest not in self._held:
+                lock = FileLock(self.lock_dir / f"{digest}.lock", shared=True)
+                # (waits for evictions of the entry in progress)
+                lock.acquire()
+                self._held[digest] = lock
+        with self._transaction():
+            entry_dir = self.entry_dir(digest)
+            entry_dir.mkdir(parents=True, exist_ok=True)
+            entry = self.entries.setdefault(digest, {"size": 0})
+            entry.update(info, last_access=time.time())
+        return entry_dir
+
+    def release(self) -> None:
+        """Allows other processes to evict the entries used so far."""
+        with self._held_lock:
+            for lock in self._held.values():
+                lock.release()
+            self._held.clear()
+
+    @contextmanager
+    def producing(self, digest: str, artifact: str) -> Iterator[None]:
+        """Excludes other processes from producing the same artifact.
+
+        Processes wanting to produce an artifact another process is already
+        producing wait for it to finish.  Afterwards, they should check
+        whether the artifact exists before producing it themselves.
+
+        Args:
+            artifact:  Name of the artifact within the entry.
+        """
+        with FileLock(self.lock_dir / f"{digest}.{artifact}.lock"):
+            yield
+
+    def update_size(self, digest: str) -> None:
+        size = dir_size(self.entry_dir(digest))
+        with self._transaction():
+            self.entries.setdefault(digest, {"last_access": time.time()})
+            self.entries[digest]["size"] = size
+
+    @property
+    def size(self) -> int:
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def evict(self) -> List[str]:
+        """Evicts least recently used entries until the cache fits the budget.
+
+        Entries in use by any process are never evicted.
+
+        Returns:
+            The evicted entries.
+        """
+        if self.budget is None:
+            return []
+        evicted = []
+        with self._transaction():
+            for digest, entry in sorted(
+                self.entries.items(), key=lambda item: item[1]["last_access"]
+            ):
+                if self.size <= self.budget:
+                    break
+                if digest in self._held:
+                    continue
+                lock = FileLock(self.lock_dir / f"{digest}.lock")
+                if not lock.acquire(blocking=False):
+                    # in use by another process
+                    continue
+                try:
+                    shutil.rmtree(self.entry_dir(digest), ignore_errors=True)
+                    del self.entries[digest]
+                    evicted.append(digest)
+                finally:
+                    lock.release()
+            # forget hashes of inputs whose entries are gone
+            self.digests = {
+                identity: digest
+                for identity, digest in self.digests.items()
+                if digest not in evicted
+            }
+        return evicted
+
+
+def adopt_legacy_entry(
+    legacy_dir: Path,
+    entry_dir: Path,
+    fov: np.ndarray,
+    feats_name: str,
+    *,
+    not_before: Optional[float] = None,
+) -> bool:
+    """Moves features cached by slide name (by earlier versions) into an entry.
+
+    The features are only adopted if the FOV cached alongside them is the
+    same as the entry's, i.e. they were extracted from the same input.
+    Earlier versions always extracted fp32 features with the plain backbone,
+    so they must only be adopted as such.
+
+    Args:
+        legacy_dir:  Cache directory named after the slide.
+        entry_dir:  Content-addressed entry for the slide.
+        fov:  The slide's FOV.
+        feats_name:  Name of the entry's features.
+        not_before:  Only adopt features written after this time (e.g. the
+            modification time of the backbone they have to be from).
+
+    Returns:
+        Whether features were adopted.
+    """
+    if has_fov(legacy_dir):
+        legacy_fov = read_fov(legacy_dir)
+    elif (legacy_dir / "fov.tif").exists():
+        from skimage.io import imread
+        legacy_fov = imread(legacy_dir / "fov.tif")[:, :, 0]
+    else:
+        return False
+    if not np.array_equal(legacy_fov, fov):
+        return False
+
+    for legacy_name, name in [
+        ("feats", feats_name),
+        ("feats.pt.zst", f"{feats_name}.pt.zst"),
+        ("feats.pt", f"{feats_name}.pt"),
+    ]:
+        if (legacy_path := legacy_dir / legacy_name).exists():
+            if not_before is not None and \
+                    legacy_path.stat().st_mtime < not_before:
+                # (extracted with an earlier version of the backbone)
+                return False
+            legacy_path.rename(entry_dir / name)
+            shutil.rmtree(legacy_dir)
+            return True
+    return False
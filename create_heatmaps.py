@@ -1,18 +1,28 @@
 #!/usr/bin/env python3
 import argparse
 import io
+from collections import deque
+from contextlib import ExitStack, nullcontext
+import json
 from pathlib import Path
 import sys
+import threading
 # import shutil
-from typing import Dict, Tuple
+from typing import (
+    Any, Callable, ContextManager, Deque, Dict, List, Optional, Sequence,
+    Tuple, Union
+)
 from concurrent import futures
-from urllib.parse import urlparse
+from urllib.parse import ParseResult, urlparse
+import traceback
 import warnings
 
 
 # loading all the below packages takes quite a bit of time, so get cli parsing
 # out of the way beforehand so it's more responsive in case of errors
 if __name__ == "__main__":
+    from sharding import parse_shard
+
     parser = argparse.ArgumentParser(
         description="Create heatmaps for MIL models."
         )
@@ -20,15 +30,21 @@ if __name__ == "__main__":
         "slide_urls",
         metavar="SLIDE_URL",
         type=urlparse,
-        nargs="+",
+        nargs="*",
         help="Slides to create heatmaps for.",
     )
     parser.add_argument(
         "-m",
         "--model-path",
+        dest="model_paths",
+        metavar="MODEL_PATH",
         type=Path,
+        action="append",
         required=True,
-        help="MIL model used to generate attention / score maps.",
+        help="MIL model used to generate attention / score maps.  Can be"
+        " given several times to evaluate several models on the same"
+        " features, in which case each model's heatmaps are written to a"
+        " subdirectory named after it.",
     )
     parser.add_argument(
         "-o", "--output-path",
@@ -37,9 +53,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "-t",
         "--true-class",
-        type=str,
+        dest="true_classes",
+        metavar="TRUE_CLASS",
+        type=lambda classes: classes.split(","),
+        action="extend",
         required=True,
-        help='Class to be rendered as "hot" in the heatmap.',
+        help='Class to be rendered as "hot" in the heatmap.  Can be given'
+        ' several times (or comma-separated), or be "all" for all of the'
+        " model's classes, in which case each class's heatmaps are written"
+        " to a subdirectory named after it.",
     )
     parser.add_argument(
         "--from-file",
@@ -60,12 +82,246 @@ if __name__ == "__main__":
         default=None,
         help="Directory to cache extracted features etc. in.",
     )
+    parser.add_argument(
+        "--cache-budget",
+        metavar="GIB",
+        type=float,
+        default=None,
+        help="Disk space (in GiB) the cache may take up.  Least recently used"
+        " cache entries are evicted beyond it.",
+    )
+    parser.add_argument(
+        "--fp16-features",
+        action="store_true",
+        help="Cache extracted features in half precision.",
+    )
+    parser.add_argument(
+        "--feature-compression",
+        metavar="LEVEL",
+        type=int,
+        default=3,
+        help="zstd compression level for cached features."
+        " 0 stores them uncompressed (and memory-mappable).",
+    )
+    parser.add_argument(
+        "--fov-compression",
+        metavar="LEVEL",
+        type=int,
+        default=1,
+        help="zstd compression level for cached FOVs."
+        " 0 stores them uncompressed (and memory-mappable).",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        metavar="MIB",
+        type=float,
+        default=None,
+        help="Memory (in MiB) to use for passing the FOV through the feature"
+        " extractor.  If given, the FOV is processed in overlapping tiles"
+        " fitting this budget instead of all at once.",
+    )
+    parser.add_argument(
+        "--skip-background",
+        action="store_true",
+        help="Only extract features for the foreground (and the regions"
+        " pooled into it).  Implies tiled feature extraction, with a default"
+        " --memory-budget of 1024 MiB.",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        metavar="N",
+        type=int,
+        default=2,
+        help="Number of slides to read (download, decode and mask) ahead of"
+        " feature extraction, and to write to the cache behind it.  0"
+        " processes slides strictly one after the other, using the least"
+        " memory.",
+    )
+    parser.add_argument(
+        "--max-downloads",
+        metavar="N",
+        type=int,
+        default=2,
+        help="Number of remote slides to download at the same time (when"
+        " reading ahead, see --pipeline-depth).",
+    )
+    parser.add_argument(
+        "--download-streams",
+        metavar="N",
+        type=int,
+        default=4,
+        help="Number of connections to download each remote slide with.",
+    )
+    parser.add_argument(
+        "--stream-remote",
+        action="store_true",
+        help="Read remote slides into memory and decode them from there,"
+        " instead of downloading them to the cache directory first.  Only"
+        " the FOVs and features derived from them are cached.",
+    )
+    parser.add_argument(
+        "--render-threads",
+        metavar="N",
+        type=int,
+        default=4,
+        help="Number of threads to render heatmaps with.",
+    )
+    parser.add_argument(
+        "--greyscale",
+        action="store_true",
+        help="Keep greyscale FOVs single-channel during feature extraction,"
+        " folding the normalisation and channel repetition into the"
+        " feature extractor's first convolution.",
+    )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Extract features with an int8 quantised backbone (on the CPU)."
+        "  The backbone is quantised once, calibrating it on the most"
+        " recently used FOVs in the cache, and saved next to the fp32 one"
+        " along with a report of how far the maps drift.",
+    )
+    parser.add_argument(
+        "--int8-calibration-fovs",
+        metavar="N",
+        type=int,
+        default=8,
+        help="Number of cached FOVs to calibrate the int8 backbone on.",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["torch", "onnxruntime"],
+        default="torch",
+        help="Framework to run the feature extractor and MIL models with."
+        "  onnxruntime exports them to ONNX (once, caching the graphs) and"
+        " runs them on the CPU.",
+    )
+    parser.add_argument(
+        "--ort-threads",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Number of threads ONNX Runtime runs each operator with."
+        "  Defaults to --threads.",
+    )
+    parser.add_argument(
+        "--render-only",
+        action="store_true",
+        help="Only render the heatmaps, from attention / score maps cached by"
+        " an earlier run with the same model, pooling and mask threshold."
+        "  Does not load the feature extractor or MIL model.",
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="ADDRESS",
+        default=None,
+        help="Instead of creating heatmaps for the given slides, keep the"
+        " models loaded and take jobs over HTTP on [HOST:]PORT or a Unix"
+        " socket (a path containing a /).",
+    )
+    parser.add_argument(
+        "--serve-workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Number of jobs to run at the same time in service mode.",
+    )
+    parser.add_argument(
+        "--serve-queue",
+        metavar="N",
+        type=int,
+        default=16,
+        help="Number of jobs which may wait to be run in service mode."
+        "  Further jobs are rejected.",
+    )
+    parser.add_argument(
+        "--watch",
+        metavar="DIR",
+        type=Path,
+        default=None,
+        help="Instead of creating heatmaps for the given slides, watch a"
+        " directory (e.g. of a live acquisition) and create the heatmaps of"
+        " each FOV written to it as soon as it is complete.  The FOVs are"
+        " normalised by the running statistics of the FOVs so far, kept in"
+        " --cohort-stats (default OUTPUT_PATH/cohort-stats.json), unless"
+        " --freeze-cohort-stats is given.",
+    )
+    parser.add_argument(
+        "--watch-pattern",
+        metavar="GLOB",
+        default="*",
+        help="Names of the files to create heatmaps for in watch mode.",
+    )
+    parser.add_argument(
+        "--watch-settle",
+        metavar="SECONDS",
+        type=float,
+        default=2.0,
+        help="Seconds a file's size and modification time have to stay the"
+        " same for it to be considered complete in watch mode.",
+    )
     parser.add_argument(
         "--force-cpu",
         type=bool,
         default=False,
         help="Forcing the use of cpu regardless of cuda availability.",
     )
+    parser.add_argument(
+        "--cohort-stats",
+        metavar="FILE",
+        type=Path,
+        default=None,
+        help="File to keep the normalisation statistics of the cohort in."
+        " If it exists, the given slides are added to the cohort described"
+        " by it.",
+    )
+    parser.add_argument(
+        "--freeze-cohort-stats",
+        action="store_true",
+        help="Normalise the heatmaps by the statistics in --cohort-stats as"
+        " they are, without adding the given slides to them.",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="RANK/N",
+        type=parse_shard,
+        default=None,
+        help="Only create the heatmaps of every N-th slide, starting with the"
+        " RANK-th (counting from 0), e.g. on one of N machines.  The shards'"
+        " cohort statistics are merged through --shard-dir before rendering,"
+        " so all runs have to be started with the same slides and options.",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="K",
+        type=int,
+        default=1,
+        help="Number of processes to split the slides between, each pinned"
+        " to its own share of the CPUs (on one NUMA node, where possible)."
+        "  Their cohort statistics are merged as for --shard.",
+    )
+    parser.add_argument(
+        # (used by --workers to pass the passwords asked for once)
+        "--passwords-from-stdin",
+        action="store_true",
+        help=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        "--threads",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Number of threads each process runs operators with.  Defaults"
+        " to the number of CPUs it may run on.",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        metavar="DIR",
+        type=Path,
+        default=None,
+        help="Directory (on a file system shared by all shards) to exchange"
+        " the shards' cohort statistics in.  Use a new one for every run.",
+    )
     threshold_group = parser.add_argument_group(
         "thresholds", "thresholds for scaling attention / score values"
     )
@@ -156,33 +412,339 @@ if __name__ == "__main__":
         args.att_lower_threshold < args.att_upper_threshold
     ), "lower attention threshold needs to be lower" \
         " than upper attention threshold."
+    assert (
+        "all" not in args.true_classes or args.true_classes == ["all"]
+    ), '"all" cannot be combined with other true classes.'
+    assert not (args.int8 and args.backend == "onnxruntime"), \
+        "the int8 backbone can only be run with the torch backend."
+    assert args.pipeline_depth >= 0, "the pipeline depth cannot be negative."
+    assert args.max_downloads > 0 and args.download_streams > 0, \
+        "slides need to be downloaded with at least one connection."
+    assert args.slide_urls or args.serve or args.watch, "no slides given."
+    assert not (args.serve and args.watch), \
+        "--serve cannot be combined with --watch."
+    assert not ((args.serve or args.watch) and args.render_only), \
+        "--render-only cannot be combined with --serve or --watch."
+    assert args.cohort_stats or not args.freeze_cohort_stats, \
+        "--freeze-cohort-stats needs --cohort-stats."
+    assert not args.shard or args.shard_dir or args.freeze_cohort_stats, \
+        "--shard needs --shard-dir to merge the cohort statistics in."
+    assert not (args.shard and (args.serve or args.watch)), \
+        "--shard cannot be combined with --serve or --watch."
+    assert args.workers > 0, "there has to be at least one worker."
+    assert args.workers == 1 or not (args.serve or args.watch), \
+        "--workers cannot be combined with --serve or --watch."
+    assert args.threads is None or args.threads > 0, \
+        "there has to be at least one thread."
+    if args.watch and not args.cohort_stats:
+        # FOVs are normalised by the statistics of the FOVs acquired so far
+        args.cohort_stats = args.output_path / "cohort-stats.json"
+
+    if args.passwords_from_stdin:
+        from sftp import remember_passwords
+        remember_passwords(json.load(sys.stdin))
+    elif args.workers > 1:
+        import tempfile
+        from sftp import ask_passwords
+        from workers import run_workers
+        # (the workers cannot all ask for them on the same terminal)
+        passwords = ask_passwords(args.slide_urls)
+        with tempfile.TemporaryDirectory(prefix="shards-") as tmp_dir:
+            sys.exit(run_workers(
+                [
+                    sys.executable, sys.argv[0], *sys.argv[1:],
+                    "--passwords-from-stdin",
+                ],
+                args.workers,
+                # (unless merged with other machines' shards, the workers'
+                # statistics only have to be exchanged locally)
+                shard_dir=args.shard_dir or Path(tmp_dir),
+                shard=args.shard,
+                threads=args.threads,
+                stdin=json.dumps(passwords).encode(),
+            ))
+
+    # the cache and rendering only need numpy & co., so heatmaps can be
+    # rendered from cached maps without loading torch & co. at all
+    from cache import CacheManifest, fingerprint
+    from locking import FileLock
+    from render import render_cohort, stats_path_for
+    from sftp import slide_identity, source_identity
 
-# load base fully convolutional model (w/o pooling / flattening or head)
-# In this case we're loading the xiyue wang RetCLL model,
-# change this bit for other networks
-if (p := "./RetCCL") not in sys.path:
-    sys.path = [p] + sys.path
-import ResNet
+    # default imgnet transforms
+    imgnet_mean, imgnet_std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    backbone_path = Path("./xiyue-wang.pth")
+
+    # features are only reused if they were extracted from the same input
+    # with the same backbone and preprocessing, attention / score maps if
+    # they were calculated from them with the same model and pooling
+    manifest = CacheManifest(
+        args.cache_dir,
+        budget=int(args.cache_budget * 2**30) if args.cache_budget else None,
+    )
+    # name models after their files, or their directories if those are the
+    # same (e.g. marugoto's export.pkl)
+    model_names = [model_path.stem for model_path in args.model_paths]
+    if len(set(model_names)) < len(model_names):
+        model_names = [model_path.resolve().parent.name
+                       for model_path in args.model_paths]
+    assert len(set(model_names)) == len(model_names), \
+        "models need to have distinct file or directory names."
+    model_digests = {
+        model_name: manifest.digest(
+            source_identity(urlparse(str(model_path))), model_path
+        )
+        for model_name, model_path in zip(model_names, args.model_paths)
+    }
+    # the models' heads are converted into artifacts which can be loaded
+    # without fastai once, then reused
+    head_paths = {
+        model_name: args.cache_dir / "heads" / "head-{}.pt".format(
+            fingerprint({"model": model_digest, "head": "fused"})
+        )
+        for model_name, model_digest in model_digests.items()
+    }
+
+    backbone_digest = manifest.digest(
+        source_identity(urlparse(str(backbone_path))), backbone_path
+    )
+    if args.int8:
+        # the quantised backbone is calibrated once (and whenever the fp32
+        # backbone changes), then reused
+        int8_path = backbone_path.with_name(
+            f"{backbone_path.stem}-int8{'-grey' if args.greyscale else ''}.pt"
+        )
+        int8_report_path = int8_path.with_suffix(".json")
+        with FileLock(int8_path.with_name(f"{int8_path.name}.lock")):
+            if not (
+                int8_path.exists() and int8_report_path.exists()
+            ) or json.loads(
+                int8_report_path.read_text()
+            )["backbone"] != backbone_digest:
+                if args.render_only:
+                    raise RuntimeError(
+                        f"no int8 backbone calibrated at {int8_path}; run"
+                        " without --render-only first"
+                    )
+                print("Calibrating int8 backbone...")
+                from mil_head import load_mil_head
+                from quantization import calibrate_backbone
+                report = calibrate_backbone(
+                    backbone_path,
+                    int8_path,
+                    manifest=manifest,
+                    backbone_digest=backbone_digest,
+                    heads={
+                        model_name: load_mil_head(
+                            model_path, head_paths[model_name]
+                        )[0]
+                        for model_name, model_path in zip(
+                            model_names, args.model_paths
+                        )
+                    },
+                    greyscale=args.greyscale,
+                    mean=imgnet_mean,
+                    std=imgnet_std,
+                    n_fovs=args.int8_calibration_fovs,
+                    blur_kernel_size=args.blur_kernel_size,
+                )
+                print(
+                    f"int8 drift on {len(report['calibration'])} FOVs"
+                    f" (see {int8_report_path}):"
+                    f"\n{json.dumps(report['drift'], indent=2)}"
+                )
+            int8_digest = manifest.digest(
+                source_identity(urlparse(str(int8_path))), int8_path
+            )
+    else:
+        int8_path = None
+    features_fingerprint = fingerprint(
+        {
+            "backbone": backbone_digest,
+            "arch": "RetCCL resnet50",
+            "mean": imgnet_mean,
+            "std": imgnet_std,
+            "fp16": args.fp16_features,
+            **({"int8": int8_digest} if args.int8 else {}),
+        }
+    )
+
+    render_options = {
+        "true_classes": args.true_classes,
+        "att_lower_threshold": args.att_lower_threshold,
+        "att_upper_threshold": args.att_upper_threshold,
+        "score_threshold": args.score_threshold,
+        "att_cmap": args.att_cmap,
+        "score_cmap": args.score_cmap,
+        "att_alpha": args.att_alpha,
+        "score_alpha": args.score_alpha,
+        "freeze_cohort_stats": args.freeze_cohort_stats,
+    }
+
+    def model_render_options(
+        output_path: Path, cohort_stats_path: Optional[Path], **options: Any
+    ) -> Dict[str, Dict[str, Any]]:
+        """Returns each model's rendering options (see `render_cohort`).
+
+        Args:
+            output_path:  Path to save the heatmaps to.
+            cohort_stats_path:  File to keep the cohort statistics in.
+            options:  Rendering options overriding the command line's.
+        """
+        several_models = len(args.model_paths) > 1
+        return {
+            model_name: {
+                **render_options,
+                **options,
+                "output_path": output_path / model_name
+                if several_models else output_path,
+                "cohort_meta": {
+                    "model": str(model_path.resolve()),
+                    "blur_kernel_size": args.blur_kernel_size,
+                    "mask_threshold": args.mask_threshold,
+                },
+                "cohort_stats_path":
+                    stats_path_for(cohort_stats_path, model_name)
+                    if cohort_stats_path and several_models
+                    else cohort_stats_path,
+                "workers": args.render_threads,
+            }
+            for model_name, model_path in zip(model_names, args.model_paths)
+        }
+
+    # maps each model's name to its path and the name of its cached maps
+    models: Dict[str, Tuple[Path, str]] = {}
+    for model_name, model_path in zip(model_names, args.model_paths):
+        maps_name = "maps-{}.npz".format(fingerprint(
+            {
+                "features": features_fingerprint,
+                "model": model_digests[model_name],
+                "blur_kernel_size": args.blur_kernel_size,
+                "mask_threshold": args.mask_threshold,
+                "skip_background": args.skip_background,
+                # the score head used to miss its batch norm statistics
+                "head": "fused",
+                # maps of fp16 features used to be calculated from the fp32
+                # ones when the features were not cached yet
+                **({"fp16_maps": "rounded"} if args.fp16_features else {}),
+            }
+        ))
+        models[model_name] = (model_path, maps_name)
+    model_options = model_render_options(args.output_path, args.cohort_stats)
+
+    # marks a failure of this shard, so the others fail as well rather than
+    # wait for its statistics forever
+    shard_failure: ContextManager[None] = nullcontext()
+    if args.shard:
+        from sharding import (
+            gather_cohort_stats, marking_failure, rank_stats_dir, shard_of
+        )
+        rank, world_size = args.shard
+        # (all shards have to agree on the cohort, or their statistics would
+        # not add up to it)
+        shard_run_id = fingerprint({
+            "slides": [slide_url.geturl() for slide_url in args.slide_urls],
+            "world_size": world_size,
+            "maps": [maps_name for _, maps_name in models.values()],
+            "true_classes": args.true_classes,
+        })
+        args.slide_urls = shard_of(args.slide_urls, rank, world_size)
+        print(
+            f"Shard {rank}/{world_size}:"
+            f" {len(args.slide_urls)} slide(s)"
+        )
+        shard_failure = marking_failure(
+            args.shard_dir, rank, run_id=shard_run_id
+        )
+
+    def render_models(
+        model_slides: Dict[str, Dict[str, Tuple[str, Path, Path]]]
+    ) -> None:
+        """Renders each model's heatmaps of the given slides.
+
+        When sharded, the shards' statistics are merged first, so that all
+        shards are normalised by the statistics of the whole cohort.
+        """
+        if not args.shard or args.freeze_cohort_stats:
+            for model_name, options in model_options.items():
+                render_cohort(model_slides[model_name], **options)
+            return
+        stats_name = args.cohort_stats.name if args.cohort_stats \
+            else "cohort-stats.json"
+        for model_name, options in model_render_options(
+            args.output_path,
+            rank_stats_dir(args.shard_dir, rank) / stats_name,
+            stats_only=True,
+        ).items():
+            if model_slides[model_name]:
+                render_cohort(model_slides[model_name], **options)
+        merged_path = gather_cohort_stats(
+            args.shard_dir,
+            rank,
+            world_size,
+            run_id=shard_run_id,
+            base=args.cohort_stats,
+        )
+        for model_name, options in model_render_options(
+            args.output_path, merged_path, freeze_cohort_stats=True
+        ).items():
+            if model_slides[model_name]:
+                render_cohort(model_slides[model_name], **options)
+
+    if args.render_only:
+        with shard_failure:
+            # maps each model's name to a map from its slides' names to
+            # their identity, cache entry and cached maps
+            model_slides: Dict[str, Dict[str, Tuple[str, Path, Path]]] = {
+                model_name: {} for model_name in models
+            }
+            for slide_url in args.slide_urls:
+                slide_name = Path(slide_url.path).stem
+                digest = manifest.known_digest(source_identity(slide_url))
+                for model_name, (_, maps_name) in models.items():
+                    if digest is None or not (
+                        maps_path := manifest.entry_dir(digest) / maps_name
+                    ).exists():
+                        raise RuntimeError(
+                            f"no cached maps of {model_name} for"
+                            f" {slide_url.geturl()}; create them by running"
+                            " without --render-only first"
+                        )
+                    slide_cache_dir = manifest.touch(
+                        digest, name=slide_name, url=slide_url.geturl()
+                    )
+                    model_slides[model_name][slide_name] = \
+                        (slide_identity(slide_url), slide_cache_dir, maps_path)
+            render_models(model_slides)
+        manifest.release()
+        manifest.evict()
+        sys.exit()
+
+from backbone import backbone_transforms, load_backbone
+from tiling import (
+    background_features, halo_for, tile_size_for_budget, tiled_features
+)
+from masking import dilate_mask, foreground_mask
+from mil_head import FusedMILHead, load_mil_head
+from pooling import gaussian_pool
+from fov_cache import has_fov, read_fov, write_fov
+from cache import adopt_legacy_entry
+from feature_store import (
+    FeatureStore, load_legacy_features, write_feature_store
+)
 
-import torch.nn as nn
 import torch
-from torchvision import transforms
 import os
-from matplotlib import pyplot as plt
 # import openslide
 from tqdm import tqdm
 import numpy as np
-from fastai.vision.all import load_learner
-from pyzstd import ZstdFile
-import PIL
-from sftp import get_wsi
+from sftp import get_wsi, read_wsi
+from matplotlib import colormaps
+from render import SlideMaps, write_maps
 
 # APC data
 # from skimage.filters import gaussian
 # from skimage.color import rgba2rgb
-from skimage.io import imread
-from skimage.io import imsave
-from skimage.transform import resize
 
 # supress DecompressionBombWarning: yes, our files are really that big (‘-’*)
 # PIL.Image.MAX_IMAGE_PIXELS = None
@@ -199,6 +761,7 @@ def _load_tile(
     # tile = slide.read_region(
     #   pos, 0, stride).convert("RGB").resize(target_size)
     tile = slide[pos[0]:pos[0] + stride[0], pos[1]:pos[1] + stride[1]]
+    from skimage.transform import resize
     tile = resize(tile, tuple(target_size), preserve_range=True)
     tile = np.repeat(tile[:, :, np.newaxis], 3, axis=2)
     # return np.array(tile)
@@ -259,437 +822,708 @@ def load_slide(slide,
     return im
 
 
-def batch1d_to_batch_2d(batch1d):
-    batch2d = nn.BatchNorm2d(batch1d.num_features)
-    batch2d.state_dict = batch1d.state_dict
-    return batch2d
+def attention_and_scores(
+    feat_t: torch.Tensor,
+    heads: Sequence[FusedMILHead],
+    *,
+    blur_kernel_size: int,
+    device: torch.device,
+) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Calculates the attention and class score maps of a feature map.
 
+    The features are pooled either once for all of the given MIL model heads,
+    or after each head's (linear) encoder projection if that means pooling
+    fewer channels, which gives the same result.
 
-def dropout1d_to_dropout2d(dropout1d):
-    return nn.Dropout2d(dropout1d.p)
-
-
-def linear_to_conv2d(linear):
-    """Converts a fully connected layer to a 1x1 Conv2d layer
-    with the same weights.
+    Returns:
+        The attention and class score maps for each head.
     """
-    conv = nn.Conv2d(in_channels=linear.in_features,
-                     out_channels=linear.out_features,
-                     kernel_size=1
-                     )
-    conv.load_state_dict(
-        {
-            "weight": linear.weight.view(conv.weight.shape),
-            "bias": linear.bias.view(conv.bias.shape),
-        }
-    )
-    return conv
+    feat_t = feat_t.to(device).unsqueeze(0)
+    pool_projected = blur_kernel_size and \
+        sum(head.projected_channels for head in heads) < feat_t.shape[1]
+
+    maps = []
+    with torch.inference_mode():
+        if blur_kernel_size and not pool_projected:
+            # pool features, but use gaussian blur instead of avg pooling
+            # to reduce artifacts
+            feat_t = gaussian_pool(feat_t, blur_kernel_size)
+        for head in heads:
+            if pool_projected:
+                att_map, score_map = head.from_projection(
+                    gaussian_pool(head.project(feat_t), blur_kernel_size)
+                )
+            else:
+                att_map, score_map = head(feat_t)
+            maps.append((att_map[0].cpu(), score_map[0].cpu()))
+
+    return maps
 
 
 if __name__ == "__main__":
-    # use all the threads
-    torch.set_num_threads(os.cpu_count() or 1)
-    torch.set_num_interop_threads(os.cpu_count() or 1)
+    # use as many threads as there are CPUs to run on (e.g. a worker's
+    # share of them), but no more
+    from workers import available_cpus
+    threads = args.threads or len(available_cpus())
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(threads)
 
     if args.force_cpu:
         device = torch.device("cpu")
     else:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    # default imgnet transforms
-    tfms = transforms.Compose(
-        [
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-        ]
-    )
+    if args.int8 or args.backend == "onnxruntime":
+        # quantised operators / ONNX Runtime's CPU provider only run on the
+        # CPU
+        device = torch.device("cpu")
 
-    base_model = ResNet.resnet50(
-        num_classes=128, mlp=False, two_branch=False, normlinear=True
-    )
-    pretext_model = torch.load("./xiyue-wang.pth", map_location=device)
-    base_model.avgpool = nn.Identity()
-    base_model.flatten = nn.Identity()
-    base_model.fc = nn.Identity()
-    base_model.load_state_dict(pretext_model, strict=True)
-    base_model = base_model.eval().to(device)
-
-    # transform MIL model into fully convolutional equivalent
-    learn = load_learner(args.model_path)
-    classes = learn.dls.train.dataset._datasets[-1].encode.categories_[0]
-    assert args.true_class in classes, (
-        f"{args.true_class} not a target of {args.model_path}! "
-        f"(Did you mean any of {list(classes)}?)"
-    )
-    true_class_idx = (classes == args.true_class).argmax()
-    att = (
-        nn.Sequential(
-            linear_to_conv2d(learn.encoder[0]),
-            nn.ReLU(),
-            linear_to_conv2d(learn.attention[0]),
-            nn.Tanh(),
-            linear_to_conv2d(learn.attention[2]),
-        )
-        .eval()
-        .to(device)
+    tfms = backbone_transforms(
+        greyscale=args.greyscale, mean=imgnet_mean, std=imgnet_std
     )
-
-    score = (
-        nn.Sequential(
-            linear_to_conv2d(learn.encoder[0]),
-            nn.ReLU(),
-            batch1d_to_batch_2d(learn.head[1]),
-            dropout1d_to_dropout2d(learn.head[2]),
-            linear_to_conv2d(learn.head[3]),
-        )
-        .eval()
-        .to(device)
+    base_model = load_backbone(
+        backbone_path,
+        greyscale=args.greyscale,
+        mean=imgnet_mean,
+        std=imgnet_std,
+        device=device,
+        int8_path=int8_path,
     )
 
-    # we operate in two steps: we first collect all attention values / scores,
-    # the entirety of which we then calculate our scaling parameters from.
-    # Only then we output the actual maps.
-    attention_maps: Dict[str, torch.Tensor] = {}
-    score_maps: Dict[str, torch.Tensor] = {}
-    masks: Dict[str, torch.Tensor] = {}
+    # tiles overlap by the backbone's receptive field, so stitching their
+    # features gives the same result as passing the whole FOV at once
+    if args.skip_background and not args.memory_budget:
+        args.memory_budget = 1024
+    if args.memory_budget:
+        halo, model_stride = halo_for(base_model)
+        tile_size = tile_size_for_budget(
+            int(args.memory_budget * 2**20), halo=halo, stride=model_stride
+        )
+    else:
+        tile_size, halo = None, None
+
+    onnx_dir = args.cache_dir / "onnx"
+    if args.backend == "onnxruntime":
+        from onnx_backend import OnnxMILHead, onnx_module
+        # (the graphs depend on everything the features do, and the input
+        # channels)
+        base_model = onnx_module(
+            base_model,
+            (tfms(np.zeros((64, 64), dtype=np.uint8)).unsqueeze(0),),
+            onnx_dir / "backbone-{}.onnx".format(fingerprint(
+                {
+                    "features": features_fingerprint,
+                    "greyscale": args.greyscale,
+                }
+            )),
+            input_names=["input"],
+            output_names=["features"],
+            threads=args.ort_threads or threads,
+        )
 
-    print("Extracting features, attentions and scores...")
-    for slide_url in (progress := tqdm(args.slide_urls, leave=False)):
-        slide_name = Path(slide_url.path).stem
-        progress.set_description(slide_name)
-        slide_cache_dir = args.cache_dir / slide_name
-        slide_cache_dir.mkdir(parents=True, exist_ok=True)
+    feature_store_options = {
+        "fp16": args.fp16_features,
+        "level": args.feature_compression or None,
+        "threads": threads,
+    }
+
+    # transform MIL models into fully convolutional equivalents
+    # (maps each model's name to its head and classes)
+    heads: Dict[str, Tuple[FusedMILHead, np.ndarray]] = {}
+    for model_name, (model_path, _) in models.items():
+        head, classes = load_mil_head(model_path, head_paths[model_name])
+        for true_class in args.true_classes:
+            assert true_class == "all" or true_class in classes, (
+                f"{true_class} not a target of {model_path}! "
+                f"(Did you mean any of {list(classes)}?)"
+            )
+        head = head.to(device)
+        if args.backend == "onnxruntime":
+            head = OnnxMILHead(  # type: ignore
+                head,
+                onnx_dir / head_paths[model_name].stem,
+                threads=args.ort_threads or threads,
+            )
+        heads[model_name] = (head, classes)
 
-        # Load FOV image if there is one in cache,
-        # or make one from the specified input, with scaling for visualisation
-        if len(sorted(slide_cache_dir.glob('fov.tif'))) > 0:
-            # if (fov_tif := slide_cache_dir / "fov*.tif").exists():
-            # slide_array = np.array(PIL.Image.open(slide_jpg))
-            # print('Using cache')
-            fov_tif_path = sorted(slide_cache_dir.glob('fov.tif'))[0]
-            slide_array = imread(fov_tif_path)
-            if len(sorted(slide_cache_dir.glob('fov.tif'))) > 1:
-                print('Warning: There was more than one fov image '
-                      'for input in cache.'
-                      )
-                print('Selected input image: {}'.format(fov_tif_path))
+    # features cached by earlier versions were always extracted in fp32 from
+    # RGB FOVs, so they are only reused as such
+    adopt_legacy_features = not (
+        args.int8 or args.fp16_features or args.greyscale
+    )
 
-        else:
-            # print('Not using cache')
-            # WHAT DOES THIS DO?
-            slide_path = get_wsi(slide_url, cache_dir=args.cache_dir)
-            # slide = openslide.OpenSlide(str(slide_path))
-            slide = imread(slide_path)
-            # slide_array = load_slide(slide)
-
-            # From grey to 3-channel
-            slide_array = np.repeat(slide[:, :, np.newaxis], 3, axis=2)
-            # PIL.Image.fromarray(slide_array).save(slide_jpg)
-
-            imsave(slide_cache_dir / 'fov.tif',
-                   slide_array,
-                   check_contrast=False
-                   )
-
-        # pass the WSI through the fully convolutional network'
-        # since our RAM is still too small, we do this in two steps
-        # (if you run out of RAM, try upping the number of slices)
-        if (feats_pt := slide_cache_dir / "feats.pt.zst").exists():
-            with ZstdFile(feats_pt, mode="rb") as fp:
-                feat_t = torch.load(io.BytesIO(fp.read()))
-            feat_t = feat_t.float()
-        elif (slide_cache_dir / "feats.pt").exists():
-            feat_t = torch.load(slide_cache_dir / "feats.pt").float()
-        else:
-            max_slice_size = 0xA800000  # experimentally determined
-            # ceil(pixels/max_slice_size)
-            # TRY SETTING NO SLICES
-            no_slices = 1
-            # no_slices = (
-            #    np.prod(slide_array.shape) + max_slice_size - 1
-            #    ) // max_slice_size
-            step = slide_array.shape[1] // no_slices
-            slices = []
-            for slice_i in range(no_slices):
-                x = tfms(slide_array[
-                            :, slice_i * step : (slice_i + 1) * step, :
-                            ]
-                         )
-                with torch.inference_mode():
-                    res = base_model(x.unsqueeze(0).to(device))
-                    slices.append(res.detach().cpu())
-            feat_t = torch.concat(slices, 3).squeeze()
-            # save the features (with compression)
-            with ZstdFile(feats_pt, mode="wb") as fp:
-                torch.save(feat_t, fp)  # type: ignore
-
-        feat_t = feat_t.to(device)
-        # pool features, but use gaussian blur instead of avg pooling
-        # to reduce artifacts
-        if args.blur_kernel_size:
-            feat_t = transforms.functional.gaussian_blur(
-                feat_t, kernel_size=args.blur_kernel_size
+    # (limits the slides read ahead which are downloaded at the same time)
+    download_slots = threading.BoundedSemaphore(args.max_downloads)
+
+    def download(
+        slide_url: ParseResult, manifest: CacheManifest
+    ) -> Tuple[str, Union[Path, bytearray]]:
+        """Returns the digest of a slide and a local copy of it.
+
+        Remote slides are downloaded into their cache entry (see
+        `sftp.get_wsi`), so they count against the cache budget until they
+        are discarded (see `prepare_slide`).  With `--stream-remote`, they
+        are read into memory instead (see `sftp.read_wsi`).
+        """
+        identity = source_identity(slide_url)
+        if not slide_url.scheme:
+            slide_path = Path(slide_url.path)
+            return manifest.digest(identity, slide_path), slide_path
+        with download_slots:
+            if args.stream_remote:
+                data = read_wsi(slide_url, streams=args.download_streams)
+                return manifest.digest(identity, data), data
+            copy_name = f"source{Path(slide_url.path).suffix}"
+            if (digest := manifest.known_digest(identity)) and (
+                copy_path := manifest.entry_dir(digest) / copy_name
+            ).exists():
+                # left behind by an interrupted run
+                return digest, copy_path
+
+            def keep(path: Path) -> Path:
+                nonlocal digest
+                # (hashed before other runs may download a newer version of
+                # the slide to the same path)
+                digest = manifest.digest(identity, path)
+                copy_path = manifest.touch(digest) / copy_name
+                path.replace(copy_path)
+                return copy_path
+
+            slide_path = get_wsi(
+                slide_url,
+                cache_dir=args.cache_dir,
+                streams=args.download_streams,
+                keep=keep,
             )
+            assert digest is not None
+            return digest, slide_path
+
+    def discard_copy(
+        slide_file: Union[None, Path, bytearray], slide_cache_dir: Path
+    ) -> None:
+        """Deletes a slide's downloaded copy once its FOV is cached."""
+        if isinstance(slide_file, Path) and \
+                slide_file.parent == slide_cache_dir:
+            slide_file.unlink(missing_ok=True)
+
+    def prepare_slide(
+        slide_url: ParseResult, manifest: CacheManifest
+    ) -> Tuple[
+        str, str, Path, Dict[str, Path], Optional[np.ndarray],
+        Optional[np.ndarray]
+    ]:
+        """Finds a slide's cache entry and reads its FOV, if still needed.
+
+        Returns:
+            The slide's name, the digest and directory of its cache entry,
+            the maps which still need to be calculated (by model name) and,
+            if there are any, the slide's FOV and foreground mask.
+        """
+        slide_name = Path(slide_url.path).stem
 
-        # calculate attention / classification scores
-        # according to the MIL model
-        with torch.inference_mode():
-            att_map = att(feat_t).squeeze().cpu()
-            score_map = score(feat_t.unsqueeze(0)).squeeze()
-            score_map = torch.softmax(score_map, 0).cpu()
+        # find the slide's cache entry by its content,
+        # reading the input only if it is unknown
+        identity = source_identity(slide_url)
+        slide_file = None
+        if (digest := manifest.known_digest(identity)) is None:
+            digest, slide_file = download(slide_url, manifest)
+        slide_cache_dir = manifest.touch(
+            digest, name=slide_name, url=slide_url.geturl()
+        )
+        # models whose maps still need to be calculated
+        pending = {
+            model_name: maps_path
+            for model_name, (_, maps_name) in models.items()
+            if not (maps_path := slide_cache_dir / maps_name).exists()
+        }
+        if not pending:
+            # nothing left to do until rendering
+            discard_copy(slide_file, slide_cache_dir)
+            return slide_name, digest, slide_cache_dir, pending, None, None
+
+        # Load FOV image if there is one in cache,
+        # or make one from the specified input
+        # (waiting for other runs already making one)
+        with manifest.producing(digest, "fov"):
+            if has_fov(slide_cache_dir):
+                grey_array = read_fov(slide_cache_dir)
+            else:
+                if slide_file is None:
+                    _, slide_file = download(slide_url, manifest)
+                # slide = openslide.OpenSlide(str(slide_file))
+                # (skimage takes a while to import, so only when needed)
+                from skimage.io import imread
+                grey_array = imread(
+                    io.BytesIO(slide_file)
+                    if isinstance(slide_file, bytearray) else slide_file
+                )
+                # (the slide's content is no longer needed once decoded)
+                if isinstance(slide_file, bytearray):
+                    slide_file = None
+                if adopt_legacy_features and (
+                    legacy_dir := args.cache_dir / slide_name
+                ).is_dir():
+                    # features cached by slide name by earlier versions
+                    adopt_legacy_entry(
+                        legacy_dir,
+                        slide_cache_dir,
+                        grey_array,
+                        f"feats-{features_fingerprint}",
+                        not_before=backbone_path.stat().st_mtime,
+                    )
+                write_fov(
+                    slide_cache_dir,
+                    grey_array,
+                    source={"url": slide_url.geturl(), "digest": digest},
+                    level=args.fov_compression or None,
+                    threads=threads,
+                )
+            discard_copy(slide_file, slide_cache_dir)
 
         # compute foreground mask
         # Leave some tiles from edges as False,
         # IDEALLY FROM POOLING ARUGUMENT...
         num_tiles_at_edge = 4
-        mask = np.full(att_map.shape, False)
-        for row in range(num_tiles_at_edge,
-                         slide_array.shape[0] // 32
-                         - num_tiles_at_edge
-                         ):
-            for column in range(num_tiles_at_edge,
-                                slide_array.shape[1] // 32
-                                - num_tiles_at_edge
-                                ):
-                # Sum over 224 x 224 for mask threshold
-                tile = slide_array[:, :, 0][
-                    (row - 3) * 32:(row + 4) * 32,
-                    (column - 3) * 32:(column + 4) * 32
-                    ]
-                mask[row, column] = tile.sum() > args.mask_threshold
-
-        attention_maps[slide_name] = att_map
-        score_maps[slide_name] = score_map
-        masks[slide_name] = mask
-
-    # now we can use all of the features to calculate the scaling factors
-    all_attentions = torch.cat(
-        [attention_maps[s].view(-1)[masks[s].reshape(-1)]
-            for s in score_maps.keys()]
-        # Without mask:
-        # [attention_maps[s].view(-1) for s in score_maps.keys()]
-    )
-    att_lower = all_attentions.quantile(args.att_lower_threshold)
-    att_upper = all_attentions.quantile(args.att_upper_threshold)
-
-    all_true_scores = torch.cat(
-        [
-            # mask out background scores, then linearize them
-            score_maps[s][true_class_idx].view(-1)[masks[s].reshape(-1)]
-            # Without masks:
-            # score_maps[s][true_class_idx].view(-1)
-            for s in score_maps.keys()
-        ]
-    )
-
-    # THIS SOMETIMES SEEMS UNHELPFUL AT THE MOMENT -
-    # MOST TRUE SCORES ARE ONE SIDE OF 0.5
-    centered_score = all_true_scores - (1 / len(classes))
-    scale_factor = torch.quantile(centered_score.abs(),
-                                  args.score_threshold
-                                  ) * 2
-
-    # For scaling cmap
-    min_true_score = all_true_scores.min()
-    max_true_score = all_true_scores.max()
-    mean_true_score = all_true_scores.mean()
-    std_true_score = all_true_scores.std()
-#    midrange_true_score = (min_true_score + max_true_score) / 2
-#    half_range_cmap = \
-#        max(abs(min_true_score - 0.5) - 0.5, abs(max_true_score) - 0.5)
+        # Sum over 224 x 224 for mask threshold
+        mask = foreground_mask(
+            grey_array,
+            args.mask_threshold,
+            num_tiles_at_edge=num_tiles_at_edge,
+        )
+        return slide_name, digest, slide_cache_dir, pending, grey_array, mask
+
+    def extract_maps(
+        slide_cache_dir: Path,
+        pending: Dict[str, Path],
+        grey_array: np.ndarray,
+        mask: np.ndarray,
+    ) -> Tuple[
+        Dict[str, Tuple[Path, SlideMaps]], Optional[Tuple[Path, torch.Tensor]]
+    ]:
+        """Calculates a slide's attention / score maps.
+
+        Has to be called while producing the slide's features (see
+        `CacheManifest.producing`).
+
+        Args:
+            pending:  Maps the name of each model to calculate the maps of
+                to the path of its cached maps.
+
+        Returns:
+            A map from each model's name to the path of its maps and the maps
+            and, if the features were extracted (instead of being read from
+            the cache), where to store them and the features.
+        """
+        # only features within the pooling radius of the foreground are
+        # extracted when skipping the background, so these caches depend
+        # on the mask and pooling
+        blur_radius = args.blur_kernel_size // 2
+        feats_name = f"feats-{features_fingerprint}"
+        sparse_feats_name = \
+            f"{feats_name}-fg{args.mask_threshold}-r{blur_radius}"
+
+        # pass the WSI through the fully convolutional network
+        # (if you run out of RAM, try setting / lowering --memory-budget)
+        feats_dir = slide_cache_dir / feats_name
+        if args.skip_background and not (
+            feats_dir.exists()
+            or feats_dir.with_suffix(".pt.zst").exists()
+            or feats_dir.with_suffix(".pt").exists()
+        ):
+            feats_dir = slide_cache_dir / sparse_feats_name
+        feat_t = None
+        new_feats = None
+        if (feats_dir / "index.json").exists():
+            feat_store = FeatureStore(feats_dir, threads=threads)
+        elif (feat_t := load_legacy_features(
+            feats_dir.with_suffix(".pt.zst")
+        )) is not None:
+            # migrate features cached by earlier versions
+            write_feature_store(feats_dir, feat_t, **feature_store_options)
+            feats_dir.with_suffix(".pt.zst").unlink(missing_ok=True)
+            feats_dir.with_suffix(".pt").unlink(missing_ok=True)
+        else:
+            if args.skip_background:
+                needed = dilate_mask(mask, blur_radius)
+                background = background_features(
+                    base_model, tfms, grey_array, device=device, halo=halo
+                )
+            else:
+                needed, background = None, None
+            feat_t = tiled_features(
+                base_model,
+                grey_array,
+                tfms,
+                device=device,
+                tile_size=tile_size,
+                halo=halo,
+                needed=needed,
+                background=background,
+            )
+            if args.fp16_features:
+                # (later runs calculate the maps from the features stored
+                # in fp16, so round these alike for the maps not to depend
+                # on whether the features were cached)
+                feat_t = feat_t.half().float()
+            new_feats = (feats_dir, feat_t)
 
-    print('\nMin true score: {:.2f}'.format(min_true_score))
-    print('\nMax true score: {:.2f}'.format(max_true_score))
+        # calculate attention / classification scores
+        # according to the MIL models (pooling the features only once)
+        pending_heads = [heads[model_name][0] for model_name in pending]
+        if feat_t is not None:
+            maps = attention_and_scores(
+                feat_t,
+                pending_heads,
+                blur_kernel_size=args.blur_kernel_size,
+                device=device,
+            )
+        else:
+            # stream over the cached features without loading all of them
+            maps = [
+                (
+                    torch.empty(feat_store.shape[1:]),
+                    torch.empty(
+                        len(heads[model_name][1]), *feat_store.shape[1:]
+                    ),
+                )
+                for model_name in pending
+            ]
+            for rows, cols, region, region_rows, region_cols in \
+                    feat_store.iter_regions(halo=blur_radius):
+                region_maps = attention_and_scores(
+                    region,
+                    pending_heads,
+                    blur_kernel_size=args.blur_kernel_size,
+                    device=device,
+                )
+                for (att_map, score_map), (region_att, region_score) in \
+                        zip(maps, region_maps):
+                    att_map[rows, cols] = \
+                        region_att[region_rows, region_cols]
+                    score_map[:, rows, cols] = \
+                        region_score[:, region_rows, region_cols]
+
+        return {
+            model_name: (
+                maps_path,
+                SlideMaps(
+                    att_map.numpy(),
+                    score_map.numpy(),
+                    mask,
+                    heads[model_name][1],
+                ),
+            )
+            for (model_name, maps_path), (att_map, score_map)
+            in zip(pending.items(), maps)
+        }, new_feats
+
+    def store_slide(
+        digest: str,
+        maps: Dict[str, Tuple[Path, SlideMaps]],
+        feats: Optional[Tuple[Path, torch.Tensor]],
+        feats_lock: ExitStack,
+        manifest: CacheManifest,
+    ) -> None:
+        """Writes a slide's maps and newly extracted features to the cache.
+
+        Args:
+            maps:  Maps each model's name to the path of its maps and the
+                maps.
+            feats:  Where to store the slide's features and the features, if
+                they were just extracted.
+            feats_lock:  Holds the lock for producing the features, which is
+                released once they are written.
+        """
+        with feats_lock:
+            if feats is not None:
+                write_feature_store(*feats, **feature_store_options)
+        for maps_path, slide_maps in maps.values():
+            write_maps(maps_path, slide_maps)
+
+        # keep the cache within its budget (entries still needed for
+        # writing the heatmaps are held by this run, so they are not
+        # evicted)
+        manifest.update_size(digest)
+        manifest.evict()
+
+    def create_maps(
+        slide_urls: Sequence[ParseResult],
+        manifest: CacheManifest,
+        on_stored: Optional[
+            Callable[[str, Dict[str, Tuple[str, Path, Path]]], Any]
+        ] = None,
+    ) -> Dict[str, Dict[str, Tuple[str, Path, Path]]]:
+        """Calculates the attention / score maps of slides (unless cached).
+
+        The slides are processed in a pipeline:  while the features of one
+        slide are extracted, the next ones are read (downloaded, decoded and
+        masked) and the maps and features of the previous ones written to
+        the cache in the background.
+
+        Args:
+            manifest:  Manifest of the cache.  The slides' cache entries are
+                held (see `CacheManifest.touch`) until it is released.
+            on_stored:  Called with each slide's name and a map from each
+                model's name to the slide's identity (see
+                `sftp.slide_identity`), cache entry and cached maps
+                as soon as they are cached (from the writer thread for
+                slides whose maps are calculated).
+
+        Returns:
+            A map from each model's name to a map from its slides' names to
+            their identity, cache entry and cached maps.
+        """
+        model_slides: Dict[str, Dict[str, Tuple[str, Path, Path]]] = {
+            model_name: {} for model_name in models
+        }
 
-    print("Writing heatmaps...")
-    for slide_url in (progress := tqdm(args.slide_urls, leave=False)):
-        slide_name = Path(slide_url.path).stem
-        slide_cache_dir = args.cache_dir / slide_name
-        slide_outdir = args.output_path / slide_name
-        slide_outdir.mkdir(parents=True, exist_ok=True)
-
-        progress.set_description(slide_name)
-        slide_outdir = args.output_path / slide_name
-
-        # slide_im = PIL.Image.open(slide_cache_dir / "slide.jpg")
-        slide_im = imread(slide_cache_dir / 'fov.tif')
-
-# ?        if not (slide_outdir / fov_tif_path.name).exists():
-# ?          shutil.copyfile(fov_tif_path,
-# ?                          slide_outdir / fov_tif_path.name
-# ?                          )
-
-        # Make and save saturated image for visualisation
-        fraction_nonzeros_to_saturate = 0.2
-        # Find brightness value of pixel to scale to 255
-        level_to_saturate = np.percentile(
-            slide_im[slide_im > 0],
-            100. * (1. - fraction_nonzeros_to_saturate)
+        print("Extracting features, attentions and scores...")
+        # slides read ahead / waiting to be written (at most
+        # --pipeline-depth each, bounding the memory they take up)
+        depth = args.pipeline_depth
+        to_read = iter(slide_urls)
+        reading: Deque[futures.Future] = deque()
+        writing: Deque[futures.Future] = deque()
+        with futures.ThreadPoolExecutor(max(depth, 1)) as readers, \
+                futures.ThreadPoolExecutor(1) as writer:
+            for slide_url in (progress := tqdm(slide_urls, leave=False)):
+                while len(reading) <= depth and \
+                        (next_url := next(to_read, None)) is not None:
+                    reading.append(
+                        readers.submit(prepare_slide, next_url, manifest)
+                    )
+                slide_name, digest, slide_cache_dir, pending, grey_array, \
+                    mask = reading.popleft().result()
+                progress.set_description(slide_name)
+                slide_maps = {
+                    model_name: (
+                        slide_identity(slide_url),
+                        slide_cache_dir,
+                        slide_cache_dir / maps_name,
+                    )
+                    for model_name, (_, maps_name) in models.items()
+                }
+                for model_name, maps_entry in slide_maps.items():
+                    model_slides[model_name][slide_name] = maps_entry
+                if not pending:
+                    if on_stored is not None:
+                        on_stored(slide_name, slide_maps)
+                    continue
+                assert grey_array is not None and mask is not None
+
+                # (features are only extracted by one run at a time; others
+                # wait for it to write them and then use them)
+                with ExitStack() as feats_lock:
+                    feats_lock.enter_context(
+                        manifest.producing(digest, "feats")
+                    )
+                    maps, new_feats = extract_maps(
+                        slide_cache_dir, pending, grey_array, mask
+                    )
+                    if new_feats is None:
+                        feats_lock.close()
+                    # (the writer releases the lock)
+                    writing.append(writer.submit(
+                        store_slide,
+                        digest,
+                        maps,
+                        new_feats,
+                        feats_lock.pop_all(),
+                        manifest,
+                    ))
+                if on_stored is not None:
+                    # (after the maps are written by the same thread)
+                    writing.append(
+                        writer.submit(on_stored, slide_name, slide_maps)
+                    )
+                while len(writing) > depth:
+                    writing.popleft().result()
+            for stored in writing:
+                stored.result()
+
+        return model_slides
+
+    def create_and_render(
+        slide_urls: Sequence[ParseResult], manifest: CacheManifest
+    ) -> None:
+        """Creates the maps of slides and renders their heatmaps.
+
+        With frozen cohort statistics, the normalisation is known before the
+        first slide, so each slide is rendered as soon as its maps are
+        cached, while the next ones' are still being calculated.  Otherwise,
+        the maps of all slides are needed first.
+        """
+        if not args.freeze_cohort_stats:
+            render_models(create_maps(slide_urls, manifest))
+            return
+        print("Writing heatmaps as the maps are ready...")
+        with futures.ThreadPoolExecutor(args.render_threads) as renderers:
+            rendered: List[futures.Future] = []
+
+            def render_slide(
+                slide_name: str,
+                slide_maps: Dict[str, Tuple[str, Path, Path]],
+            ) -> None:
+                for model_name, options in model_options.items():
+                    rendered.append(renderers.submit(
+                        render_cohort,
+                        {slide_name: slide_maps[model_name]},
+                        **{**options, "workers": 1, "quiet": True},
+                    ))
+
+            create_maps(slide_urls, manifest, on_stored=render_slide)
+            for future in rendered:
+                future.result()
+
+    def job_render_options(job: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Returns each model's rendering options for a service job.
+
+        Jobs are JSON objects with the slides to create heatmaps for and
+        optionally where to save them and rendering options overriding the
+        command line's, e.g.
+
+            {"slides": ["/data/fov1.tif", "sftp://host/data/fov2.tif"],
+             "output_path": "/results/fov1-2", "true_classes": ["tumour"],
+             "cohort_stats": "/results/stats.json", "att_cmap": "viridis"}
+        """
+        # (jobs come from clients, so they are checked even with -O)
+        unknown = set(job) - {
+            "slides", "output_path", "cohort_stats", *render_options
+        }
+        if unknown:
+            raise ValueError(f"unknown job fields {sorted(unknown)}.")
+        if not (
+            job.get("slides") and isinstance(job["slides"], list)
+            and all(isinstance(url, str) for url in job["slides"])
+        ):
+            raise ValueError("jobs need a list of slides.")
+        if not all(
+            isinstance(job.get(key, ""), str)
+            for key in ["output_path", "cohort_stats"]
+        ):
+            raise ValueError("paths have to be strings.")
+        options = {key: job[key] for key in render_options if key in job}
+        checked = {**render_options, **options}
+        true_classes = checked["true_classes"]
+        if not (
+            true_classes and isinstance(true_classes, list)
+            and all(isinstance(c, str) for c in true_classes)
+        ):
+            raise ValueError("true classes have to be a list of strings.")
+        if true_classes != ["all"]:
+            if "all" in true_classes:
+                raise ValueError(
+                    '"all" cannot be combined with other true classes.'
+                )
+            for model_name, (_, classes) in heads.items():
+                if unknown := [
+                    c for c in true_classes if c not in classes.tolist()
+                ]:
+                    raise ValueError(
+                        f"{unknown} not targets of {model_name}"
+                        f" (any of {classes.tolist()})."
+                    )
+        quantities = [
+            "att_lower_threshold", "att_upper_threshold", "score_threshold",
+            "att_alpha", "score_alpha",
+        ]
+        if not all(
+            isinstance(checked[key], (int, float))
+            and not isinstance(checked[key], bool)
+            and 0 <= checked[key] <= 1
+            for key in quantities
+        ):
+            raise ValueError(
+                "thresholds and alphas have to be numbers in [0, 1]."
+            )
+        if checked["att_lower_threshold"] >= checked["att_upper_threshold"]:
+            raise ValueError(
+                "lower attention threshold needs to be lower than upper"
+                " attention threshold."
             )
-        # Scale and clip
-        slide_im_vis = slide_im * 255. / level_to_saturate
-        slide_im_vis[slide_im_vis > 255.] = 255.
-        slide_im_vis = np.uint8(np.round(slide_im_vis))
-        # Save
-        im_vis_save_path = slide_outdir / \
-            "fov-sat{}pc.tif".format(
-                round(fraction_nonzeros_to_saturate * 100)
+        for key in ["att_cmap", "score_cmap"]:
+            if not (
+                isinstance(checked[key], str) and checked[key] in colormaps
+            ):
+                raise ValueError(
+                    f"{key} {checked[key]!r} is not a matplotlib color map."
                 )
-        imsave(im_vis_save_path, slide_im_vis, check_contrast=False)
-
-        # Get mask from masks calculated earlier
-        mask = masks[slide_name]
-
-        # attention map
-        att_map = (attention_maps[slide_name] - att_lower) \
-            / (att_upper - att_lower)
-        att_map = att_map * mask
-        att_map = att_map.clamp(0, 1)
-
-        # bare attention
-        im = plt.get_cmap(args.att_cmap)(att_map)
-        im[:, :, 3] = mask
-
-        # PIL.Image.fromarray(np.uint8(im * 255.0))\
-        # .save(slide_outdir / "attention.png")
-        imsave(slide_outdir / 'attention.png',
-               np.uint8(np.round(im * 255.0)),
-               check_contrast=False
-               )
-
-        # attention map (blended with slide)
-
-        # map_im = PIL.Image.fromarray(np.uint8(im * 255.0))
-
-        # Resize to match input image: * 32 for ResNet50
-        # and crop right- and bottom-most pixels
-        # map_im = map_im.resize(slide_im.size, PIL.Image.Resampling.NEAREST)
-        upscaled_att_map = resize(im, [im.shape[0] * 32,
-                                       im.shape[1] * 32,
-                                       4
-                                       ], order=0, preserve_range=True
-                                  )
-        upscaled_att_map = upscaled_att_map[0:slide_im.shape[0],
-                                            0:slide_im.shape[1]
-                                            ]
-        upscaled_att_map = np.uint8(np.round(upscaled_att_map * 255.))
-
-        imsave(slide_outdir / 'upscaled_attention.png',
-               upscaled_att_map,
-               check_contrast=False
-               )
-
-        att_map_overlay = PIL.Image.fromarray(slide_im_vis, mode='RGB')
-        att_map_overlay.convert('RGBA')
-        upscaled_att_map[:, :, 3] = np.uint8(np.round(args.att_alpha * 255.))
-        upscaled_att_map = PIL.Image.fromarray(upscaled_att_map)
-        att_map_overlay.paste(upscaled_att_map, mask=upscaled_att_map)
-        att_map_overlay.convert('RGB')
-        att_map_overlay.save(slide_outdir / 'attention-map-overlay.png')
-
-        # Multiply FOV image version
-#        slide_im_vis_norm = slide_im_vis / 255.  # 0 to 1
-#        attention_coded_image = \
-#           upscaled_att_map[:, :, 0:3] * slide_im_vis_norm
-#        attention_coded_image = np.uint8(attention_coded_image)
-#        imsave(slide_outdir / 'attention-coded-fov.tif',
-#               attention_coded_image,
-#               check_contrast=False
-#               )
-
-        # Score map
-
-        # THIS WAS THE ORIGINAL SCALING
-#        scaled_score_map = (
-#            score_maps[slide_name][true_class_idx] - 1 / len(classes)
-#        ) / scale_factor + 1 / len(classes)
-#        scaled_score_map = (scaled_score_map * mask).clamp(0, 1)
-
-        # scales to 0-1
-#        score_map_min_0 = \
-#            score_maps[slide_name][true_class_idx] \
-#            - score_maps[slide_name][true_class_idx].min()
-#        scaled_score_map = \
-#            score_map_min_0 / score_map_min_0.max()
-
-        # ANOTHER SCALING OPTION:
-        # 0.5 will be at cmap 0.5; furthest from 0.5 is cmap 0 or 1
-        # score_map = score_maps[slide_name][true_class_idx]
-        # scaled_score_map = 0.5 + (score_map - 0.5) * 0.5 / half_range_cmap
-
-        # AND ANOTHER:
-        # Scales true scores to 0-1
-#        score_map = score_maps[slide_name][true_class_idx]
-#        scaled_score_map = \
-#            0.5 * ((score_map - midrange_true_score)
-#                   / (max_true_score - midrange_true_score)
-#                   + 1
-#                   )
-
-        # AND ANOTHER:
-        # Scale mean +- 3 * std to 0-1
-        score_map = score_maps[slide_name][true_class_idx]
-        scaled_score_map = \
-            ((score_map - mean_true_score) / (3 * std_true_score) + 1) * 0.5
-
-        # Include score_threshold argument for scaling
-        # scaled_score_map = \
-        #   (scaled_score_map - 0.5) * 0.5 / (args.score_threshold - 0.5) + 0.5
-        # THRESHOLD ONLY HIGH
-        # scaled_score_map = scaled_score_map / args.score_threshold
-
-        scaled_score_map = scaled_score_map.clamp(0, 1)
-
-        # create image with RGB from scores, Alpha from attention
-        im = plt.get_cmap(args.score_cmap)(scaled_score_map)
-        im[:, :, 3] = att_map * mask * args.score_alpha
-
-        map_im = np.uint8(im * 255.0)
-
-        imsave(slide_outdir / 'score-map.png',
-               map_im,
-               check_contrast=False
-               )
-
-        # Upscaled score map
-
-        # map_im = map_im.resize(slide_im.size, PIL.Image.Resampling.NEAREST)
-
-        # Resize to match input image: * 32 for ResNet50
-        # and crop right- and bottom-most pixels
-        # map_im = map_im.resize(slide_im.size, PIL.Image.Resampling.NEAREST)
-        map_im = resize(im, [im.shape[0] * 32,
-                             im.shape[1] * 32,
-                             4
-                             ], order=0, preserve_range=True
+        if not isinstance(checked["freeze_cohort_stats"], bool):
+            raise ValueError("freeze_cohort_stats has to be true or false.")
+        if checked["freeze_cohort_stats"] and not (
+            job.get("cohort_stats") or args.cohort_stats
+        ):
+            raise ValueError("frozen cohort statistics need cohort_stats.")
+        return model_render_options(
+            Path(job.get("output_path", args.output_path)),
+            Path(job["cohort_stats"]) if job.get("cohort_stats")
+            else args.cohort_stats,
+            **options,
+        )
+
+    def run_job(job: Dict[str, Any]) -> Dict[str, Any]:
+        """Creates the heatmaps of a service job.
+
+        Returns:
+            The directories the heatmaps of each model were written to.
+        """
+        options = job_render_options(job)
+        # (each job holds its own cache entries)
+        job_manifest = CacheManifest(args.cache_dir, budget=manifest.budget)
+        try:
+            model_slides = create_maps(
+                [urlparse(url) for url in job["slides"]], job_manifest
+            )
+            return {
+                "outputs": {
+                    model_name: [
+                        str(slide_outdir)
+                        for slide_outdir in render_cohort(
+                            model_slides[model_name], **model_options
                         )
-        map_im = np.uint8(np.round(map_im[0:slide_im.shape[0],
-                                          0:slide_im.shape[1]] * 255.
-                                   )
-                          )
-        map_im_save = PIL.Image.new(mode='RGBA',
-                                    size=(map_im.shape[1], map_im.shape[0]),
-                                    color='white'
-                                    )
-        map_im = PIL.Image.fromarray(map_im)
-        map_im_save.paste(map_im, mask=map_im)
-        map_im_save.convert('RGB')
-
-        map_im_save.save(slide_outdir / 'upscaled_score-map.png')
-
-        # Multiply FOV image by score map
-#        slide_im_vis_norm = slide_im_vis / 255.  # 0 to 1
-#        score_coded_image = map_im[:, :, 0:3] * slide_im_vis_norm
-#        score_coded_image = np.uint8(score_coded_image)
-#        imsave(slide_outdir / 'score-coded-fov.tif',
-#               score_coded_image,
-#               check_contrast=False
-#               )
-
-        # Overlay scores onto image, transparency is attention score
-        score_map_overlay = PIL.Image.fromarray(slide_im_vis, mode='RGB')
-        score_map_overlay.convert('RGBA')
-        # map_im = PIL.Image.fromarray(map_im)
-        score_map_overlay.paste(map_im, mask=map_im)
-        score_map_overlay.convert('RGB')
-        score_map_overlay.save(slide_outdir / 'score-map-overlay.png')
+                    ]
+                    for model_name, model_options in options.items()
+                }
+            }
+        finally:
+            job_manifest.release()
+            job_manifest.evict()
+
+    if args.serve:
+        from service import serve
+        serve(
+            args.serve,
+            run_job,
+            validate=job_render_options,
+            workers=args.serve_workers,
+            max_queued=args.serve_queue,
+        )
+    elif args.watch:
+        from watch import watch_directory
+        print(f"Watching {args.watch} for FOVs...")
+        try:
+            for fov_path in watch_directory(
+                args.watch, args.watch_pattern, settle=args.watch_settle
+            ):
+                try:
+                    model_slides = create_maps(
+                        [urlparse(str(fov_path))], manifest
+                    )
+                    for model_name, options in model_options.items():
+                        render_cohort(model_slides[model_name], **options)
+                except Exception:
+                    # (one broken FOV should not end the watch)
+                    traceback.print_exc()
+                finally:
+                    manifest.release()
+                    manifest.evict()
+        except KeyboardInterrupt:
+            pass
+    else:
+        with shard_failure:
+            create_and_render(args.slide_urls, manifest)
+
+    # allow other runs to evict this run's cache entries, and keep the cache
+    # within its budget now that they are no longer needed
+    manifest.release()
+    manifest.evict()
@@ -0,0 +1,231 @@
+"""Chunked storage for feature maps.
+
+Feature maps used to be cached as a single zstd-compressed `torch.save` blob,
+which has to be decompressed in one go (in a single thread) and briefly needs
+two copies of the features in memory.  Here, feature maps are split into
+spatial chunks, each saved as a `.npy` file, which is either stored as is (so
+it can be memory-mapped) or compressed with zstd.  Chunks are (de)compressed
+in parallel and can be read individually, so regions of a feature map can be
+processed without loading all of it.
+
+A store is a directory with the following layout:
+
+    index.json      shape, dtype, chunk size and compression of the features
+    {row}_{col}.npy[.zst]
+                    (channels, chunk_size, chunk_size) chunk in chunk row
+                    `row` and column `col`, cropped at the feature map edges
+"""
+import io
+import json
+import os
+import shutil
+from concurrent import futures
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+from pyzstd import ZstdFile, compress, decompress
+
+
+FORMAT_VERSION = 1
+
+
+class FeatureStore:
+    """A chunked feature map on disk.
+
+    Args:
+        path:  Directory of the store.
+        threads:  Number of threads to (de)compress chunks with.
+    """
+
+    def __init__(self, path: Path, *, threads: Optional[int] = None) -> None:
+        self.path = path
+        with open(path / "index.json") as fp:
+            index = json.load(fp)
+        if index["format"] != FORMAT_VERSION:
+            raise RuntimeError(
+                f"unsupported feature store format {index['format']} in {path}"
+            )
+        self.shape: Tuple[int, int, int] = \
+            tuple(index["shape"])  # type: ignore
+        self.dtype = np.dtype(index["dtype"])
+        self.chunk_size: int = index["chunk_size"]
+        self.compressed: bool = index["compressed"]
+        self.threads = threads or min(32, os.cpu_count() or 1)
+
+    @property
+    def chunks(self) -> Tuple[int, int]:
+        """Number of chunk rows and columns."""
+        return (-(-self.shape[1] // self.chunk_size),
+                -(-self.shape[2] // self.chunk_size))
+
+    def _chunk_path(self, row: int, col: int) -> Path:
+        return self.path / (
+            f"{row}_{col}.npy" + (".zst" if self.compressed else "")
+        )
+
+    def read_chunk(self, row: int, col: int) -> np.ndarray:
+        """Reads a chunk.
+
+        Uncompressed chunks are returned as (read-only) memory maps.
+        """
+        chunk_path = self._chunk_path(row, col)
+        if not self.compressed:
+            return np.load(chunk_path, mmap_mode="r")
+        with open(chunk_path, "rb") as fp:
+            return np.load(io.BytesIO(decompress(fp.read())))
+
+    def read(
+        self, rows: slice = slice(None), cols: slice = slice(None)
+    ) -> torch.Tensor:
+        """Reads a (channels, rows, cols) region of the feature map as fp32."""
+        _, height, width = self.shape
+        row_start, row_stop, _ = rows.indices(height)
+        col_start, col_stop, _ = cols.indices(width)
+        region = torch.empty(
+            self.shape[0], row_stop - row_start, col_stop - col_start
+        )
+        cs = self.chunk_size
+
+        def copy_chunk(row: int, col: int) -> None:
+            chunk = self.read_chunk(row, col)
+            # part of the chunk within the region
+            r0, r1 = max(row_start, row * cs), min(row_stop, (row + 1) * cs)
+            c0, c1 = max(col_start, col * cs), min(col_stop, (col + 1) * cs)
+            region[:, r0 - row_start:r1 - row_start,
+                   c0 - col_start:c1 - col_start] = torch.from_numpy(
+                # (copied, as memory-mapped chunks are read-only)
+                np.array(chunk[:, r0 - row * cs:r1 - row * cs,
+                               c0 - col * cs:c1 - col * cs])
+            ).float()
+
+        with futures.ThreadPoolExecutor(self.threads) as executor:
+            for future in [
+                executor.submit(copy_chunk, row, col)
+                for row in range(row_start // cs, -(-row_stop // cs))
+                for col in range(col_start // cs, -(-col_stop // cs))
+            ]:
+                future.result()
+
+        return region
+
+    def iter_regions(
+        self, halo: int = 0
+    ) -> Iterator[Tuple[slice, slice, torch.Tensor, slice, slice]]:
+        """Iterates over the feature map chunk by chunk.
+
+        Args:
+            halo:  Number of features around each chunk to read as well, e.g.
+                to allow for exact blurring of the chunk.
+
+        Yields:
+            The (row, column) slices of a chunk within the feature map, the
+            chunk's features including the halo (clipped at the feature map
+            edges) and the (row, column) slices of the chunk within them.
+        """
+        _, height, width = self.shape
+        cs = self.chunk_size
+        for row in range(0, height, cs):
+            for col in range(0, width, cs):
+                rows = slice(row, min(height, row + cs))
+                cols = slice(col, min(width, col + cs))
+                halo_rows = slice(max(0, row - halo),
+                                  min(height, rows.stop + halo))
+                halo_cols = slice(max(0, col - halo),
+                                  min(width, cols.stop + halo))
+                yield (
+                    rows,
+                    cols,
+                    self.read(halo_rows, halo_cols),
+                    slice(row - halo_rows.start, rows.stop - halo_rows.start),
+                    slice(col - halo_cols.start, cols.stop - halo_cols.start),
+                )
+
+
+def write_feature_store(
+    path: Path,
+    feats: torch.Tensor,
+    *,
+    chunk_size: int = 64,
+    fp16: bool = False,
+    level: Optional[int] = 3,
+    threads: Optional[int] = None,
+) -> FeatureStore:
+    """Saves a (channels, height, width) feature map as a chunked store.
+
+    The store is written next to `path` first and then moved into place, so
+    readers never see a partially written store.
+
+    Args:
+        chunk_size:  Height / width of the chunks.
+        fp16:  Whether to store the features in half precision.
+        level:  zstd compression level.  If None, chunks are stored
+            uncompressed, which allows them to be memory-mapped.
+        threads:  Number of threads to compress chunks with.
+    """
+    features = feats.detach().cpu().numpy()
+    if fp16:
+        features = features.astype(np.float16)
+    _, height, width = features.shape
+
+    tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    def write_chunk(row: int, col: int) -> None:
+        chunk = np.ascontiguousarray(
+            features[:, row * chunk_size:(row + 1) * chunk_size,
+                     col * chunk_size:(col + 1) * chunk_size]
+        )
+        if level is None:
+            np.save(tmp_path / f"{row}_{col}.npy", chunk)
+        else:
+            buffer = io.BytesIO()
+            np.save(buffer, chunk)
+            with open(tmp_path / f"{row}_{col}.npy.zst", "wb") as fp:
+                fp.write(compress(buffer.getbuffer(), level))
+
+    with futures.ThreadPoolExecutor(
+        threads or min(32, os.cpu_count() or 1)
+    ) as executor:
+        for future in [
+            executor.submit(write_chunk, row, col)
+            for row in range(-(-height // chunk_size))
+            for col in range(-(-width // chunk_size))
+        ]:
+            future.result()
+
+    with open(tmp_path / "index.json", "w") as fp:
+        json.dump(
+            {
+                "format": FORMAT_VERSION,
+                "shape": list(features.shape),
+                "dtype": features.dtype.name,
+                "chunk_size": chunk_size,
+                "compressed": level is not None,
+            },
+            fp,
+        )
+
+    shutil.rmtree(path, ignore_errors=True)
+    tmp_path.rename(path)
+    return FeatureStore(path, threads=threads)
+
+
+def load_legacy_features(feats_pt: Path) -> Optional[torch.Tensor]:
+    """Loads features cached as `feats.pt(.zst)` by earlier versions.
+
+    Args:
+        feats_pt:  Path of the `.pt.zst` cache.  An uncompressed `.pt` file
+            with the same stem is tried as well.
+
+    Returns:
+        The features, or None if there is no such cache.
+    """
+    if feats_pt.exists():
+        with ZstdFile(feats_pt, mode="rb") as fp:
+            return torch.load(io.BytesIO(fp.read())).float()
+    elif (pt := feats_pt.with_suffix("")).exists():
+        return torch.load(pt).float()
+    return None
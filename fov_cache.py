@@ -0,0 +1,113 @@
+"""Compact on-disk cache of FOV images.
+
+FOVs used to be cached as `fov.tif`, repeated into three identical channels
+and uncompressed.  Here, they are kept single-channel, either compressed with
+(fast, multi-threaded) zstd or stored uncompressed so they can be opened as
+memory maps.  A small header records the FOV's shape, dtype and where it came
+from:
+
+    fov.json        shape, dtype, compression and source of the FOV
+    fov.npy[.zst]   the (height, width) FOV
+"""
+import io
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+from pyzstd import CParameter, compress, decompress
+
+
+HEADER_NAME = "fov.json"
+
+
+def _fov_path(cache_dir: Path, compressed: bool) -> Path:
+    return cache_dir / ("fov.npy.zst" if compressed else "fov.npy")
+
+
+def grey_to_rgb(image: np.ndarray) -> np.ndarray:
+    """Repeats a single-channel FOV into three identical channels."""
+    return np.repeat(image[:, :, np.newaxis], 3, axis=2)
+
+
+def has_fov(cache_dir: Path) -> bool:
+    return (cache_dir / HEADER_NAME).exists()
+
+
+def write_fov(
+    cache_dir: Path,
+    fov: np.ndarray,
+    *,
+    source: Optional[Dict[str, Any]] = None,
+    level: Optional[int] = 1,
+    threads: Optional[int] = None,
+) -> None:
+    """Caches a single-channel FOV.
+
+    The header is written last, so a FOV is only considered cached once it
+    has been written completely.
+
+    Args:
+        source:  Information about where the FOV came from (e.g. its URL).
+        level:  zstd compression level.  If None, the FOV is stored
+            uncompressed, which allows it to be memory-mapped.
+        threads:  Number of threads to compress with.
+    """
+    assert fov.ndim == 2, "only single-channel FOVs can be cached"
+    fov_path = _fov_path(cache_dir, compressed=level is not None)
+    tmp_path = fov_path.with_name(fov_path.name + f".{os.getpid()}.tmp")
+    if level is None:
+        with open(tmp_path, "wb") as fp:
+            np.save(fp, fov)
+    else:
+        buffer = io.BytesIO()
+        np.save(buffer, fov)
+        with open(tmp_path, "wb") as fp:
+            fp.write(compress(
+                buffer.getbuffer(),
+                {
+                    CParameter.compressionLevel: level,
+                    CParameter.nbWorkers: threads or os.cpu_count() or 1,
+                },
+            ))
+    tmp_path.replace(fov_path)
+
+    header_path = cache_dir / HEADER_NAME
+    tmp_header_path = header_path.with_name(
+        header_path.name + f".{os.getpid()}.tmp"
+    )
+    with open(tmp_header_path, "w") as fp:
+        json.dump(
+            {
+                "shape": list(fov.shape),
+                "dtype": fov.dtype.str,
+                "compressed": level is not None,
+                "source": source or {},
+            },
+            fp,
+        )
+    tmp_header_path.replace(header_path)
+
+
+def read_fov_header(cache_dir: Path) -> Dict[str, Any]:
+    with open(cache_dir / HEADER_NAME) as fp:
+        return json.load(fp)
+
+
+def read_fov(cache_dir: Path) -> np.ndarray:
+    """Reads a cached FOV.
+
+    Uncompressed FOVs are returned as (read-only) memory maps.
+    """
+    header = read_fov_header(cache_dir)
+    fov_path = _fov_path(cache_dir, compressed=header["compressed"])
+    if header["compressed"]:
+        with open(fov_path, "rb") as fp:
+            fov = np.load(io.BytesIO(decompress(fp.read())))
+    else:
+        fov = np.load(fov_path, mmap_mode="r")
+    assert list(fov.shape) == header["shape"] \
+        and fov.dtype.str == header["dtype"], \
+        f"cached FOV in {cache_dir} does not match its header"
+    return fov
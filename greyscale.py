@@ -0,0 +1,125 @@
+"""Single-channel input for backbones trained on normalised RGB images.
+
+Greyscale FOVs used to be repeated into three identical channels, which were
+then normalised per channel and passed through the backbone's first
+convolution.  As both the normalisation and the convolution are linear, they
+can be folded into a single-channel convolution giving the same result on the
+greyscale image directly, saving two thirds of the input memory and of the
+first convolution's work.
+"""
+from typing import List, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class GreyscaleConv2d(nn.Module):
+    """Single-channel equivalent of a normalisation followed by a convolution.
+
+    For an input x repeated into C channels, normalising channel c to
+    (x - mean[c]) / std[c] and convolving with weight[:, c] is the same as
+    convolving x with sum_c weight[:, c] / std[c] and subtracting the
+    convolution of the image's support (i.e. a ones image, zero-padded like
+    the input) with sum_c weight[:, c] * mean[c] / std[c].  The latter only
+    differs from a constant at the image borders, so we compute it on a small
+    image and subtract it region by region.
+    """
+
+    def __init__(
+        self, conv: nn.Conv2d, mean: Sequence[float], std: Sequence[float]
+    ) -> None:
+        super().__init__()
+        assert conv.groups == 1 and conv.padding_mode == "zeros", \
+            "only ungrouped, zero-padded convolutions can be folded"
+        mean_t = torch.tensor(mean, dtype=conv.weight.dtype).view(1, -1, 1, 1)
+        std_t = torch.tensor(std, dtype=conv.weight.dtype).view(1, -1, 1, 1)
+        weight = conv.weight.detach()
+        self.weight = nn.Parameter((weight / std_t).sum(1, keepdim=True))
+        self.register_buffer(
+            "offset_weight", (weight * mean_t / std_t).sum(1, keepdim=True)
+        )
+        self.bias = (
+            nn.Parameter(conv.bias.detach().clone())
+            if conv.bias is not None else None
+        )
+        self.kernel_size: Tuple[int, int] = conv.kernel_size  # type: ignore
+        self.stride: Tuple[int, int] = conv.stride  # type: ignore
+        self.padding: Tuple[int, int] = conv.padding  # type: ignore
+        self.dilation: Tuple[int, int] = conv.dilation  # type: ignore
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = F.conv2d(
+            x, self.weight, self.bias, self.stride, self.padding, self.dilation
+        )
+        if torch.onnx.is_in_onnx_export():
+            # exported graphs take inputs of any size, so the support cannot
+            # be reduced to a fixed-size image;  convolve all of it instead
+            return out - F.conv2d(
+                torch.ones_like(x),
+                self.offset_weight,
+                None,
+                self.stride,
+                self.padding,
+                self.dilation,
+            )
+        # convolution of the (zero-padded) support on a reduced image with
+        # the same border behaviour as the actual input
+        small_shape = [
+            _reduced_size(size, kernel, stride, dilation)
+            for size, kernel, stride, dilation in zip(
+                x.shape[-2:], self.kernel_size, self.stride, self.dilation
+            )
+        ]
+        offset = F.conv2d(
+            x.new_ones(1, 1, *small_shape),
+            self.offset_weight,
+            None,
+            self.stride,
+            self.padding,
+            self.dilation,
+        )
+        for out_rows, offset_rows in _regions(
+            out.shape[-2], offset.shape[-2]
+        ):
+            for out_cols, offset_cols in _regions(
+                out.shape[-1], offset.shape[-1]
+            ):
+                out[..., out_rows, out_cols] -= \
+                    offset[..., offset_rows, offset_cols]
+        return out
+
+
+def _reduced_size(size: int, kernel: int, stride: int, dilation: int) -> int:
+    # smallest size (congruent to `size` modulo the stride, so the padding at
+    # the far end behaves identically) with some border-free outputs
+    base = 4 * (dilation * (kernel - 1) + stride)
+    if size <= base + stride:
+        return size
+    return base + (size - base) % stride
+
+
+def _regions(size: int, small_size: int) -> List[Tuple[slice, slice]]:
+    # maps the leading / middle / trailing outputs to the equivalent ones of
+    # the reduced image
+    if size == small_size:
+        return [(slice(None), slice(None))]
+    lead = small_size // 2
+    trail = small_size - lead - 1
+    return [
+        (slice(0, lead), slice(0, lead)),
+        (slice(lead, size - trail), slice(lead, lead + 1)),
+        (slice(size - trail, size), slice(small_size - trail, small_size)),
+    ]
+
+
+def fold_greyscale_input(
+    model: nn.Module, mean: Sequence[float], std: Sequence[float]
+) -> nn.Module:
+    """Makes a model with normalised RGB input take raw greyscale images.
+
+    Replaces the model's first convolution (`model.conv1`) with an equivalent
+    single-channel one, which also takes care of the normalisation.
+    """
+    model.conv1 = GreyscaleConv2d(model.conv1, mean, std)
+    return model
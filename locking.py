@@ -0,0 +1,60 @@
+"""Advisory file locks for coordinating processes sharing a directory."""
+import fcntl
+from pathlib import Path
+from typing import IO, Optional
+
+
+class FileLock:
+    """An advisory (`flock`) lock on a file.
+
+    Locks are held per lock object, so two `FileLock`s on the same path
+    exclude each other even within the same process.  They are released when
+    the process exits, so crashed processes never leave stale locks behind.
+
+    Args:
+        path:  Path of the lock file.  It is created if necessary.
+        shared:  Whether to take a shared (reader) instead of an exclusive
+            (writer) lock.
+    """
+
+    def __init__(self, path: Path, *, shared: bool = False) -> None:
+        self.path = path
+        self.shared = shared
+        self._fp: Optional[IO] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Acquires the lock.
+
+        Args:
+            blocking:  Whether to wait for the lock if it is held elsewhere.
+
+        Returns:
+            Whether the lock was acquired.
+        """
+        assert self._fp is None, f"lock {self.path} is already held"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fp = open(self.path, "a+")
+        try:
+            fcntl.flock(
+                fp,
+                (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+                | (0 if blocking else fcntl.LOCK_NB),
+            )
+        except BlockingIOError:
+            fp.close()
+            return False
+        self._fp = fp
+        return True
+
+    def release(self) -> None:
+        if self._fp is not None:
+            fcntl.flock(self._fp, fcntl.LOCK_UN)
+            self._fp.close()
+            self._fp = None
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
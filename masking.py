@@ -0,0 +1,90 @@
+"""Foreground masks for FOVs."""
+import numpy as np
+
+
+def foreground_mask(
+    grey_array: np.ndarray,
+    threshold: float,
+    *,
+    num_tiles_at_edge: int = 4,
+    stride: int = 32,
+    window: int = 7,
+) -> np.ndarray:
+    """Calculates which features of a FOV lie in its foreground.
+
+    A feature is considered foreground if the brightness summed over the
+    (window * stride)^2 pixels centred on its stride^2 cell exceeds the
+    threshold.  Features within `num_tiles_at_edge` cells of the top / left
+    edges and of the last complete cells at the bottom / right edges are
+    always background.
+
+    Rather than summing each window separately, all window sums are taken
+    from a summed-area table of the per-cell sums.
+
+    Args:
+        grey_array:  Single-channel FOV of shape (height, width).
+        threshold:  Brightness threshold for background removal.
+        num_tiles_at_edge:  Number of cells at the edges to leave as
+            background.
+        stride:  Size of the cell each feature corresponds to.
+        window:  Size of the summation window, in cells.
+
+    Returns:
+        A boolean mask of shape (ceil(height/stride), ceil(width/stride)).
+    """
+    height, width = grey_array.shape
+    mask = np.full((-(-height // stride), -(-width // stride)), False)
+
+    # cells wholly within the FOV
+    rows, cols = height // stride, width // stride
+    before, after = window // 2, window - window // 2
+    assert num_tiles_at_edge >= before, \
+        "windows of non-edge tiles have to lie within the FOV"
+    if rows - num_tiles_at_edge <= num_tiles_at_edge \
+            or cols - num_tiles_at_edge <= num_tiles_at_edge:
+        return mask
+
+    # sum exactly for integer images
+    dtype = np.int64 if np.issubdtype(grey_array.dtype, np.integer) \
+        else np.float64
+    cell_sums = grey_array[:rows * stride, :cols * stride] \
+        .reshape(rows, stride, cols, stride) \
+        .sum(axis=(1, 3), dtype=dtype)
+
+    summed_area = np.zeros((rows + 1, cols + 1), dtype=dtype)
+    summed_area[1:, 1:] = cell_sums.cumsum(0).cumsum(1)
+
+    top = np.arange(num_tiles_at_edge, rows - num_tiles_at_edge)[:, np.newaxis]
+    left = np.arange(num_tiles_at_edge, cols - num_tiles_at_edge)
+    window_sums = (
+        summed_area[top + after, left + after]
+        - summed_area[top - before, left + after]
+        - summed_area[top + after, left - before]
+        + summed_area[top - before, left - before]
+    )
+    mask[
+        num_tiles_at_edge:rows - num_tiles_at_edge,
+        num_tiles_at_edge:cols - num_tiles_at_edge,
+    ] = window_sums > threshold
+
+    return mask
+
+
+def dilate_mask(mask: np.ndarray, radius: int) -> np.ndarray:
+    """Grows a mask by `radius` elements (in a square neighbourhood)."""
+    if radius <= 0:
+        return mask.copy()
+    padded = np.pad(mask, radius).astype(np.int64)
+    summed_area = np.zeros(
+        (padded.shape[0] + 1, padded.shape[1] + 1), dtype=np.int64
+    )
+    summed_area[1:, 1:] = padded.cumsum(0).cumsum(1)
+    size = 2 * radius + 1
+    rows, cols = mask.shape
+    window_sums = (
+        summed_area[size:size + rows, size:size + cols]
+        - summed_area[:rows, size:size + cols]
+        - summed_area[size:size + rows, :cols]
+        + summed_area[:rows, :cols]
+    )
+    return window_sums > 0
@@ -0,0 +1,212 @@
+"""Fully convolutional versions of marugoto MIL model heads.
+
+A marugoto attention MIL model consists of
+
+    encoder     Linear(features, n), ReLU
+    attention   Linear(n, m), Tanh, Linear(m, 1)
+    head        Flatten, BatchNorm1d(n), Dropout, Linear(n, classes)
+
+where the attention and head both operate on the encoder's projection.
+Applying the layers to each position of a feature map (as 1x1 convolutions)
+gives attention and score maps.
+
+Loading a model (with fastai) takes longer than creating heatmaps for a
+small FOV, so the converted heads are kept in a small standalone artifact
+(see `load_mil_head`), which only needs torch to load.
+"""
+import os
+from pathlib import Path
+from typing import Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from locking import FileLock
+
+
+def linear_to_conv2d(linear: nn.Linear) -> nn.Conv2d:
+    """Converts a fully connected layer to a 1x1 Conv2d layer
+    with the same weights.
+    """
+    conv = nn.Conv2d(in_channels=linear.in_features,
+                     out_channels=linear.out_features,
+                     kernel_size=1
+                     )
+    conv.load_state_dict(
+        {
+            "weight": linear.weight.view(conv.weight.shape),
+            "bias": linear.bias.view(conv.bias.shape),
+        }
+    )
+    return conv
+
+
+def fold_batchnorm_into_linear(
+    batchnorm: nn.BatchNorm1d, linear: nn.Linear
+) -> nn.Linear:
+    """Folds an (evaluation mode) batch norm into the linear layer after it.
+
+    Returns:
+        A linear layer equivalent to applying `batchnorm`, then `linear`.
+    """
+    assert batchnorm.track_running_stats, \
+        "batch norms need running statistics to be folded"
+    scale = batchnorm.weight / torch.sqrt(
+        batchnorm.running_var + batchnorm.eps  # type: ignore
+    )
+    shift = batchnorm.bias - batchnorm.running_mean * scale  # type: ignore
+    fused = nn.Linear(linear.in_features, linear.out_features)
+    with torch.no_grad():
+        fused.weight.copy_(linear.weight * scale)
+        fused.bias.copy_(linear.bias + linear.weight @ shift)
+    return fused
+
+
+class FusedMILHead(nn.Module):
+    """Attention and score heads of a marugoto MIL model in one module.
+
+    The encoder projection, which both heads start with, is only calculated
+    once, and the head's batch norm (with its trained statistics) is folded
+    into its final layer.  Dropout is left out, as the module is only meant
+    for inference.
+
+    Args:
+        n_feats:  Number of input features.
+        n_projected:  Number of features the encoder projects them to.
+        n_attention:  Size of the attention's hidden layer.
+        n_classes:  Number of classes.
+    """
+
+    def __init__(
+        self, n_feats: int, n_projected: int, n_attention: int, n_classes: int
+    ) -> None:
+        super().__init__()
+        self.projection = nn.Conv2d(n_feats, n_projected, kernel_size=1)
+        self.attention = nn.Sequential(
+            nn.Conv2d(n_projected, n_attention, kernel_size=1),
+            nn.Tanh(),
+            nn.Conv2d(n_attention, 1, kernel_size=1),
+        )
+        self.score = nn.Conv2d(n_projected, n_classes, kernel_size=1)
+
+    @classmethod
+    def from_learner(cls, learn) -> "FusedMILHead":
+        """Converts the heads of a (fastai) MIL model learner."""
+        encoder, attention = learn.encoder[0], learn.attention[0]
+        head = cls(
+            encoder.in_features,
+            encoder.out_features,
+            attention.out_features,
+            learn.head[3].out_features,
+        )
+        head.projection = linear_to_conv2d(encoder)
+        head.attention = nn.Sequential(
+            linear_to_conv2d(attention),
+            nn.Tanh(),
+            linear_to_conv2d(learn.attention[2]),
+        )
+        head.score = linear_to_conv2d(
+            fold_batchnorm_into_linear(learn.head[1], learn.head[3])
+        )
+        return head
+
+    @property
+    def sizes(self) -> Tuple[int, int, int, int]:
+        """The arguments to create a head of the same shape with."""
+        return (
+            self.projection.in_channels,
+            self.projection.out_channels,
+            self.attention[0].out_channels,
+            self.score.out_channels,
+        )
+
+    @property
+    def projected_channels(self) -> int:
+        return self.projection.out_channels
+
+    def project(self, feats: torch.Tensor) -> torch.Tensor:
+        """Applies the (linear) encoder projection to feature maps.
+
+        As it is linear, the projection commutes with (normalised) linear
+        filters such as gaussian pooling.
+        """
+        return self.projection(feats)
+
+    def from_projection(
+        self, projected: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Calculates attention and class score maps from projected features.
+
+        Args:
+            projected:  (batch, projected channels, height, width) projected
+                feature maps (see `project`).
+
+        Returns:
+            The (batch, height, width) attention maps and the
+            (batch, classes, height, width) class scores (as probabilities).
+        """
+        encoded = torch.relu(projected)
+        attention = self.attention(encoded)[:, 0]
+        scores = torch.softmax(self.score(encoded), 1)
+        return attention, scores
+
+    def forward(
+        self, feats: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Calculates attention and class score maps.
+
+        Args:
+            feats:  (batch, features, height, width) feature maps.
+
+        Returns:
+            See `from_projection`.
+        """
+        return self.from_projection(self.project(feats))
+
+
+def save_mil_head(
+    path: Path, head: FusedMILHead, classes: Sequence[str]
+) -> None:
+    """Saves a head and the names of its classes to a standalone artifact."""
+    tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    torch.save(
+        {
+            "sizes": list(head.sizes),
+            "classes": list(classes),
+            "state_dict": head.state_dict(),
+        },
+        tmp_path,
+    )
+    tmp_path.replace(path)
+
+
+def load_mil_head(
+    model_path: Path, head_path: Path
+) -> Tuple[FusedMILHead, np.ndarray]:
+    """Loads the fused head of a MIL model and the names of its classes.
+
+    The model is only loaded (with fastai) if it has not been converted to a
+    head artifact yet;  the artifact is then saved for later runs.
+
+    Args:
+        model_path:  The (fastai) MIL model learner.
+        head_path:  Where the model's head artifact is kept.  It has to
+            change whenever the model does.
+    """
+    head_path.parent.mkdir(parents=True, exist_ok=True)
+    # (runs sharing the artifact wait for each other's conversions)
+    with FileLock(head_path.with_name(head_path.name + ".lock")):
+        if not head_path.exists():
+            from fastai.vision.all import load_learner
+            learn = load_learner(model_path)
+            save_mil_head(
+                head_path,
+                FusedMILHead.from_learner(learn),
+                learn.dls.train.dataset._datasets[-1].encode
+                .categories_[0].tolist(),
+            )
+    artifact = torch.load(head_path, map_location="cpu", weights_only=True)
+    head = FusedMILHead(*artifact["sizes"])
+    head.load_state_dict(artifact["state_dict"])
+    return head.eval(), np.array(artifact["classes"])
@@ -0,0 +1,86 @@
+"""Gaussian pooling of feature maps.
+
+Gives the same result as `torchvision.transforms.functional.gaussian_blur`
+(reflection padding, default sigma), but exploits the separability of the
+gaussian kernel:  instead of one (k x k) convolution per channel, each
+channel is convolved with a k-tap kernel along its rows, then its columns.
+For large kernels, these 1D convolutions are done via FFT instead.
+"""
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+
+
+# kernel size from which 1D convolutions are done via FFT (roughly where it
+# starts to pay off on CPUs)
+FFT_KERNEL_SIZE = 191
+
+
+def gaussian_kernel1d(
+    kernel_size: int, sigma: Optional[float] = None
+) -> torch.Tensor:
+    """Normalised 1D gaussian kernel.
+
+    Args:
+        sigma:  Standard deviation of the gaussian.  Defaults to the one
+            torchvision uses for the kernel size.
+    """
+    if sigma is None:
+        sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+    half_size = (kernel_size - 1) * 0.5
+    x = torch.linspace(-half_size, half_size, steps=kernel_size)
+    kernel = torch.exp(-0.5 * (x / sigma).pow(2))
+    return kernel / kernel.sum()
+
+
+def _conv1d_fft(x: torch.Tensor, kernel: torch.Tensor) -> torch.Tensor:
+    # valid convolution of the last dimension of x with a (symmetric) kernel
+    length = x.shape[-1]
+    # (the circular convolution's wrap-around only affects invalid outputs)
+    n = 1 << (length - 1).bit_length()
+    result = torch.fft.irfft(
+        torch.fft.rfft(x, n=n) * torch.fft.rfft(kernel, n=n), n=n
+    )
+    return result[..., len(kernel) - 1:length]
+
+
+def _conv1d(x: torch.Tensor, kernel: torch.Tensor, dim: int) -> torch.Tensor:
+    # valid convolution of a (N, C, H, W) tensor along its height / width
+    if len(kernel) >= FFT_KERNEL_SIZE:
+        if dim == 2:
+            return _conv1d_fft(x.transpose(2, 3), kernel).transpose(2, 3)
+        return _conv1d_fft(x, kernel)
+    channels = x.shape[1]
+    weight = kernel.view(1, 1, -1, 1) if dim == 2 \
+        else kernel.view(1, 1, 1, -1)
+    # (depthwise convolutions are a lot faster with channels last)
+    return F.conv2d(
+        x.contiguous(memory_format=torch.channels_last),
+        weight.repeat(channels, 1, 1, 1),
+        groups=channels,
+    )
+
+
+def gaussian_pool(
+    feats: torch.Tensor, kernel_size: int, sigma: Optional[float] = None
+) -> torch.Tensor:
+    """Blurs each channel of a feature map with a gaussian.
+
+    The result may be in channels last memory format.
+
+    Args:
+        feats:  (channels, height, width) or (batch, channels, height,
+            width) feature map.
+        kernel_size:  Size of the (odd) gaussian kernel.
+        sigma:  Standard deviation of the gaussian (see `gaussian_kernel1d`).
+    """
+    assert kernel_size % 2 == 1, "kernel size needs to be odd."
+    unbatched = feats.dim() == 3
+    if unbatched:
+        feats = feats.unsqueeze(0)
+    kernel = gaussian_kernel1d(kernel_size, sigma).to(feats)
+    radius = kernel_size // 2
+    padded = F.pad(feats, [radius] * 4, mode="reflect")
+    pooled = _conv1d(_conv1d(padded, kernel, dim=3), kernel, dim=2)
+    return pooled[0] if unbatched else pooled
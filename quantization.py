@@ -0,0 +1,263 @@
+"""Int8 post-training quantisation of the feature extractor.
+
+On CPUs, most of the time is spent passing FOVs through the (fp32) backbone.
+Statically quantising it to int8 (weights per channel, activations per
+tensor, with fused convolutions and ReLUs) makes that several times faster.
+The activations' ranges are calibrated on tiles of cached FOVs.  As the
+quantised features only approximate the fp32 ones, the drift of the MIL
+models' attention and score maps is measured on the same tiles, so it can be
+judged whether the speed-up is acceptable.
+
+The quantised backbone is kept next to the fp32 one:
+
+    <backbone>-int8[-grey].pt     state of the quantised backbone
+    <backbone>-int8[-grey].json   calibration inputs and map drift
+"""
+import copy
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from backbone import backbone_transforms, load_backbone
+from cache import CacheManifest
+from fov_cache import has_fov, read_fov
+from greyscale import GreyscaleConv2d
+from mil_head import FusedMILHead
+from pooling import gaussian_pool
+
+
+# size of the (square) FOV tiles to calibrate on
+CALIBRATION_TILE_SIZE = 1024
+
+
+def _prepare(model: nn.Module, engine: str) -> nn.Module:
+    # inserts observers recording the ranges of the activations to quantise
+    example = torch.zeros(1, model.conv1.weight.shape[1], 64, 64)
+    return prepare_fx(
+        copy.deepcopy(model),
+        get_default_qconfig_mapping(engine),
+        (example,),
+        # (its border handling cannot be traced, so it stays fp32)
+        prepare_custom_config={
+            "non_traceable_module_class": [GreyscaleConv2d]
+        },
+    )
+
+
+def quantize_backbone(
+    model: nn.Module, calibration_inputs: Iterable[torch.Tensor]
+) -> nn.Module:
+    """Statically quantises a (fused) backbone to int8.
+
+    Args:
+        model:  The backbone in evaluation mode.  It is left unchanged.
+        calibration_inputs:  (1, channels, height, width) inputs to calibrate
+            the activations' quantisation ranges on.
+
+    Returns:
+        The quantised backbone, taking and returning fp32 tensors.
+    """
+    prepared = _prepare(model, torch.backends.quantized.engine)
+    with torch.inference_mode():
+        for x in calibration_inputs:
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def save_quantized_backbone(model: nn.Module, path: Path) -> None:
+    tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    torch.save(
+        {
+            "engine": torch.backends.quantized.engine,
+            "state_dict": model.state_dict(),
+        },
+        tmp_path,
+    )
+    tmp_path.replace(path)
+
+
+def load_quantized_backbone(model: nn.Module, path: Path) -> nn.Module:
+    """Loads a backbone quantised by `quantize_backbone`.
+
+    Args:
+        model:  The fp32 backbone it was quantised from.
+    """
+    state = torch.load(path, map_location="cpu")
+    torch.backends.quantized.engine = state["engine"]
+    quantized = convert_fx(_prepare(model, state["engine"]))
+    quantized.load_state_dict(state["state_dict"])
+    return quantized
+
+
+def calibration_tiles(
+    fovs: Sequence[np.ndarray], *, tiles_per_fov: int = 2, seed: int = 0
+) -> List[np.ndarray]:
+    """Picks random (but reproducible) tiles from FOVs."""
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for fov in fovs:
+        height, width = (
+            min(size, CALIBRATION_TILE_SIZE) for size in fov.shape[:2]
+        )
+        for _ in range(tiles_per_fov):
+            row = rng.integers(fov.shape[0] - height + 1)
+            col = rng.integers(fov.shape[1] - width + 1)
+            tiles.append(fov[row:row + height, col:col + width])
+    return tiles
+
+
+def map_drift(
+    fp32_model: nn.Module,
+    int8_model: nn.Module,
+    heads: Dict[str, FusedMILHead],
+    inputs: Sequence[torch.Tensor],
+    *,
+    blur_kernel_size: int,
+) -> Dict[str, Any]:
+    """Measures how far the quantised backbone's heatmaps are off.
+
+    Returns:
+        The mean cosine similarity of the fp32 and int8 features and, for
+        each MIL model, the maximum absolute error of its attention (also
+        relative to the fp32 attention's range), the correlation of the
+        attention maps, the maximum and mean absolute error of its class
+        scores, and the fraction of positions where the top class agrees.
+    """
+    similarities = []
+    # fp32 / int8 attention and (positions, classes) scores of each model
+    attention: Dict[str, Tuple[List[torch.Tensor], ...]] = {
+        name: ([], []) for name in heads
+    }
+    scores: Dict[str, Tuple[List[torch.Tensor], ...]] = {
+        name: ([], []) for name in heads
+    }
+    with torch.inference_mode():
+        for x in inputs:
+            feats = fp32_model(x), int8_model(x)
+            similarities.append(
+                torch.cosine_similarity(*feats, dim=1).flatten()
+            )
+            if blur_kernel_size:
+                feats = tuple(
+                    gaussian_pool(f, blur_kernel_size) for f in feats
+                )
+            for name, head in heads.items():
+                for f, att_acc, score_acc in zip(
+                    feats, attention[name], scores[name]
+                ):
+                    att_map, score_map = head(f)
+                    att_acc.append(att_map.flatten())
+                    score_acc.append(
+                        score_map.movedim(1, -1).flatten(end_dim=-2)
+                    )
+
+    drift: Dict[str, Any] = {
+        "feature_cosine_similarity":
+            torch.cat(similarities).mean().item(),
+        "models": {},
+    }
+    for name in heads:
+        fp32_att, int8_att = (torch.cat(acc) for acc in attention[name])
+        fp32_scores, int8_scores = (torch.cat(acc) for acc in scores[name])
+        att_error = (int8_att - fp32_att).abs().max().item()
+        score_error = (int8_scores - fp32_scores).abs()
+        drift["models"][name] = {
+            "attention_max_abs_error": att_error,
+            "attention_max_rel_error":
+                att_error / (fp32_att.max() - fp32_att.min()).item(),
+            "attention_correlation":
+                torch.corrcoef(torch.stack([fp32_att, int8_att]))[0, 1]
+                .item(),
+            "score_max_abs_error": score_error.max().item(),
+            "score_mean_abs_error": score_error.mean().item(),
+            "top_class_agreement":
+                (fp32_scores.argmax(-1) == int8_scores.argmax(-1))
+                .float().mean().item(),
+        }
+    return drift
+
+
+def calibrate_backbone(
+    backbone_path: Path,
+    int8_path: Path,
+    *,
+    manifest: CacheManifest,
+    backbone_digest: str,
+    heads: Dict[str, FusedMILHead],
+    greyscale: bool,
+    mean: Sequence[float],
+    std: Sequence[float],
+    n_fovs: int,
+    blur_kernel_size: int,
+) -> Dict[str, Any]:
+    """Quantises the backbone, calibrating it on cached FOVs.
+
+    The quantised backbone is saved to `int8_path`, and a report of the
+    calibration and the drift of the maps (see `map_drift`) next to it.
+
+    Args:
+        manifest:  Cache to take the most recently used FOVs from.
+        backbone_digest:  Content hash of the fp32 backbone, recorded in the
+            report so stale quantised backbones can be recognised.
+        heads:  MIL model heads (by name) to measure the drift of the maps
+            with.
+        n_fovs:  Number of FOVs to calibrate on.
+
+    Returns:
+        The report.
+    """
+    calibration = []
+    fovs = []
+    for digest, entry in sorted(
+        manifest.entries.items(),
+        key=lambda item: item[1]["last_access"],
+        reverse=True,
+    ):
+        if len(fovs) == n_fovs:
+            break
+        if has_fov(entry_dir := manifest.entry_dir(digest)):
+            fovs.append(read_fov(entry_dir))
+            calibration.append({"digest": digest, "name": entry.get("name")})
+    if not fovs:
+        raise RuntimeError(
+            f"no cached FOVs in {manifest.cache_dir} to calibrate the int8"
+            " backbone on; create some heatmaps without --int8 first"
+        )
+
+    cpu = torch.device("cpu")
+    fp32_model = load_backbone(
+        backbone_path, greyscale=greyscale, mean=mean, std=std, device=cpu
+    )
+    tfms = backbone_transforms(greyscale=greyscale, mean=mean, std=std)
+    inputs = [tfms(tile).unsqueeze(0) for tile in calibration_tiles(fovs)]
+    int8_model = quantize_backbone(fp32_model, inputs)
+
+    report = {
+        "backbone": backbone_digest,
+        "engine": torch.backends.quantized.engine,
+        "greyscale": greyscale,
+        "calibration": calibration,
+        "blur_kernel_size": blur_kernel_size,
+        "drift": map_drift(
+            fp32_model,
+            int8_model,
+            heads,
+            inputs,
+            blur_kernel_size=blur_kernel_size,
+        ),
+    }
+    # (the backbone is saved last, so it is never found without its report)
+    report_path = int8_path.with_suffix(".json")
+    tmp_path = report_path.with_name(report_path.name + f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(report, fp, indent=2)
+    tmp_path.replace(report_path)
+    save_quantized_backbone(int8_model, int8_path)
+    return report
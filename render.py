@@ -0,0 +1,472 @@
+"""Rendering of heatmaps from attention / score maps.
+
+Everything here only needs numpy & co. (no torch or fastai), so heatmaps can
+be re-rendered from cached attention / score maps (see `--render-only`)
+without loading any models.  The maps are cached as a `.npz` file per slide:
+
+    attention   (height, width) attention map
+    scores      (classes, height, width) class score map
+    mask        (height, width) foreground mask
+    classes     (classes,) names of the classes
+"""
+import os
+from concurrent import futures
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import PIL.Image
+from matplotlib import colormaps
+from skimage.io import imsave
+from skimage.transform import resize
+from tqdm import tqdm
+
+from fov_cache import grey_to_rgb, read_fov
+from locking import FileLock
+from sketches import CohortStats
+
+
+# fraction of the FOV's non-zero pixels to saturate for visualisation
+FRACTION_NONZEROS_TO_SATURATE = 0.2
+
+
+class SlideMaps(NamedTuple):
+    attention: np.ndarray
+    scores: np.ndarray
+    mask: np.ndarray
+    classes: np.ndarray
+
+
+def write_maps(path: Path, maps: SlideMaps) -> None:
+    """Caches a slide's attention / score maps and mask."""
+    tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as fp:
+        np.savez(
+            fp,
+            attention=np.asarray(maps.attention, dtype=np.float32),
+            scores=np.asarray(maps.scores, dtype=np.float32),
+            mask=np.asarray(maps.mask, dtype=bool),
+            classes=np.asarray(maps.classes, dtype=str),
+        )
+    tmp_path.replace(path)
+
+
+def read_maps(path: Path) -> SlideMaps:
+    with np.load(path) as maps:
+        return SlideMaps(
+            maps["attention"], maps["scores"], maps["mask"], maps["classes"]
+        )
+
+
+def saturate_fov(slide_im: np.ndarray) -> np.ndarray:
+    """Makes a saturated RGB version of a FOV for visualisation."""
+    # Find brightness value of pixel to scale to 255
+    level_to_saturate = np.percentile(
+        slide_im[slide_im > 0],
+        100. * (1. - FRACTION_NONZEROS_TO_SATURATE)
+        )
+    # Scale and clip
+    slide_im_vis = slide_im * 255. / level_to_saturate
+    slide_im_vis[slide_im_vis > 255.] = 255.
+    return grey_to_rgb(np.uint8(np.round(slide_im_vis)))
+
+
+def render_heatmaps(
+    slide_outdir: Path,
+    slide_im_vis: np.ndarray,
+    att_map: np.ndarray,
+    true_score_map: np.ndarray,
+    mask: np.ndarray,
+    *,
+    att_lower: float,
+    att_upper: float,
+    score_mean: float,
+    score_std: float,
+    att_cmap: str = "magma",
+    score_cmap: str = "coolwarm",
+    att_alpha: float = 0.5,
+    score_alpha: float = 1.0,
+) -> None:
+    """Writes the heatmaps of a slide.
+
+    Args:
+        slide_outdir:  Directory to write the heatmaps to.
+        slide_im_vis:  The slide's saturated FOV (see `saturate_fov`).
+        att_map:  The slide's attention map.
+        true_score_map:  The slide's score map for the true class.
+        mask:  The slide's foreground mask.
+        att_lower:  Attention value to map to 0.
+        att_upper:  Attention value to map to 1.
+        score_mean:  Mean of the cohort's (foreground) true class scores.
+        score_std:  Standard deviation of the cohort's true class scores.
+    """
+    # Save saturated image for visualisation
+    im_vis_save_path = slide_outdir / \
+        "fov-sat{}pc.tif".format(
+            round(FRACTION_NONZEROS_TO_SATURATE * 100)
+            )
+    imsave(im_vis_save_path, slide_im_vis, check_contrast=False)
+
+    # attention map
+    att_map = (att_map - att_lower) / (att_upper - att_lower)
+    att_map = att_map * mask
+    att_map = np.clip(att_map, 0, 1)
+
+    # bare attention
+    im = colormaps[att_cmap](att_map)
+    im[:, :, 3] = mask
+
+    # PIL.Image.fromarray(np.uint8(im * 255.0))\
+    # .save(slide_outdir / "attention.png")
+    imsave(slide_outdir / 'attention.png',
+           np.uint8(np.round(im * 255.0)),
+           check_contrast=False
+           )
+
+    # attention map (blended with slide)
+
+    # map_im = PIL.Image.fromarray(np.uint8(im * 255.0))
+
+    # Resize to match input image: * 32 for ResNet50
+    # and crop right- and bottom-most pixels
+    # map_im = map_im.resize(slide_im.size, PIL.Image.Resampling.NEAREST)
+    upscaled_att_map = resize(im, [im.shape[0] * 32,
+                                   im.shape[1] * 32,
+                                   4
+                                   ], order=0, preserve_range=True
+                              )
+    upscaled_att_map = upscaled_att_map[0:slide_im_vis.shape[0],
+                                        0:slide_im_vis.shape[1]
+                                        ]
+    upscaled_att_map = np.uint8(np.round(upscaled_att_map * 255.))
+
+    imsave(slide_outdir / 'upscaled_attention.png',
+           upscaled_att_map,
+           check_contrast=False
+           )
+
+    att_map_overlay = PIL.Image.fromarray(slide_im_vis, mode='RGB')
+    att_map_overlay.convert('RGBA')
+    upscaled_att_map[:, :, 3] = np.uint8(np.round(att_alpha * 255.))
+    upscaled_att_map = PIL.Image.fromarray(upscaled_att_map)
+    att_map_overlay.paste(upscaled_att_map, mask=upscaled_att_map)
+    att_map_overlay.convert('RGB')
+    att_map_overlay.save(slide_outdir / 'attention-map-overlay.png')
+
+    # Multiply FOV image version
+#    slide_im_vis_norm = slide_im_vis / 255.  # 0 to 1
+#    attention_coded_image = \
+#       upscaled_att_map[:, :, 0:3] * slide_im_vis_norm
+#    attention_coded_image = np.uint8(attention_coded_image)
+#    imsave(slide_outdir / 'attention-coded-fov.tif',
+#           attention_coded_image,
+#           check_contrast=False
+#           )
+
+    # Score map
+
+    # THIS WAS THE ORIGINAL SCALING
+#    scaled_score_map = (
+#        score_maps[slide_name][true_class_idx] - 1 / len(classes)
+#    ) / scale_factor + 1 / len(classes)
+#    scaled_score_map = (scaled_score_map * mask).clamp(0, 1)
+
+    # scales to 0-1
+#    score_map_min_0 = \
+#        score_maps[slide_name][true_class_idx] \
+#        - score_maps[slide_name][true_class_idx].min()
+#    scaled_score_map = \
+#        score_map_min_0 / score_map_min_0.max()
+
+    # ANOTHER SCALING OPTION:
+    # 0.5 will be at cmap 0.5; furthest from 0.5 is cmap 0 or 1
+    # score_map = score_maps[slide_name][true_class_idx]
+    # scaled_score_map = 0.5 + (score_map - 0.5) * 0.5 / half_range_cmap
+
+    # AND ANOTHER:
+    # Scales true scores to 0-1
+#    score_map = score_maps[slide_name][true_class_idx]
+#    scaled_score_map = \
+#        0.5 * ((score_map - midrange_true_score)
+#               / (max_true_score - midrange_true_score)
+#               + 1
+#               )
+
+    # AND ANOTHER:
+    # Scale mean +- 3 * std to 0-1
+    scaled_score_map = \
+        ((true_score_map - score_mean) / (3 * score_std) + 1) * 0.5
+
+    # Include score_threshold argument for scaling
+    # scaled_score_map = \
+    #   (scaled_score_map - 0.5) * 0.5 / (args.score_threshold - 0.5) + 0.5
+    # THRESHOLD ONLY HIGH
+    # scaled_score_map = scaled_score_map / args.score_threshold
+
+    scaled_score_map = np.clip(scaled_score_map, 0, 1)
+
+    # create image with RGB from scores, Alpha from attention
+    im = colormaps[score_cmap](scaled_score_map)
+    im[:, :, 3] = att_map * mask * score_alpha
+
+    map_im = np.uint8(im * 255.0)
+
+    imsave(slide_outdir / 'score-map.png',
+           map_im,
+           check_contrast=False
+           )
+
+    # Upscaled score map
+
+    # map_im = map_im.resize(slide_im.size, PIL.Image.Resampling.NEAREST)
+
+    # Resize to match input image: * 32 for ResNet50
+    # and crop right- and bottom-most pixels
+    # map_im = map_im.resize(slide_im.size, PIL.Image.Resampling.NEAREST)
+    map_im = resize(im, [im.shape[0] * 32,
+                         im.shape[1] * 32,
+                         4
+                         ], order=0, preserve_range=True
+                    )
+    map_im = np.uint8(np.round(map_im[0:slide_im_vis.shape[0],
+                                      0:slide_im_vis.shape[1]] * 255.
+                               )
+                      )
+    map_im_save = PIL.Image.new(mode='RGBA',
+                                size=(map_im.shape[1], map_im.shape[0]),
+                                color='white'
+                                )
+    map_im = PIL.Image.fromarray(map_im)
+    map_im_save.paste(map_im, mask=map_im)
+    map_im_save.convert('RGB')
+
+    map_im_save.save(slide_outdir / 'upscaled_score-map.png')
+
+    # Multiply FOV image by score map
+#    slide_im_vis_norm = slide_im_vis / 255.  # 0 to 1
+#    score_coded_image = map_im[:, :, 0:3] * slide_im_vis_norm
+#    score_coded_image = np.uint8(score_coded_image)
+#    imsave(slide_outdir / 'score-coded-fov.tif',
+#           score_coded_image,
+#           check_contrast=False
+#           )
+
+    # Overlay scores onto image, transparency is attention score
+    score_map_overlay = PIL.Image.fromarray(slide_im_vis, mode='RGB')
+    score_map_overlay.convert('RGBA')
+    # map_im = PIL.Image.fromarray(map_im)
+    score_map_overlay.paste(map_im, mask=map_im)
+    score_map_overlay.convert('RGB')
+    score_map_overlay.save(slide_outdir / 'score-map-overlay.png')
+
+
+def stats_path_for(cohort_stats_path: Path, name: str) -> Path:
+    """File to keep part of a cohort's statistics (e.g. a class's) in."""
+    return cohort_stats_path.with_name(
+        f"{cohort_stats_path.stem}-{name}{cohort_stats_path.suffix}"
+    )
+
+
+def render_cohort(
+    slides: Dict[str, Tuple[str, Path, Path]],
+    *,
+    output_path: Path,
+    true_classes: Sequence[str],
+    cohort_meta: Dict[str, Any],
+    cohort_stats_path: Optional[Path] = None,
+    freeze_cohort_stats: bool = False,
+    stats_only: bool = False,
+    att_lower_threshold: float = 0.01,
+    att_upper_threshold: float = 1.0,
+    score_threshold: float = 0.95,
+    workers: int = 1,
+    quiet: bool = False,
+    **render_options: Any,
+) -> List[Path]:
+    """Writes the heatmaps of a cohort from cached attention / score maps.
+
+    The maps' intensities are scaled by statistics of the whole cohort, which
+    are calculated for each true class separately.
+
+    Args:
+        slides:  Maps each slide's name to its identity in the cohort
+            statistics (e.g. `sftp.slide_identity`), its cache entry
+            (holding its FOV) and its cached maps.
+        true_classes:  Classes to render as "hot", or ["all"] for all of the
+            model's classes.  If there are several, each class's heatmaps are
+            written to a subdirectory named after it.
+        cohort_meta:  Parameters the maps were calculated with (see
+            `CohortStats`).  The true class is added for each class.
+        cohort_stats_path:  File to keep the cohort's statistics in.  If it
+            exists, the slides are added to the cohort described by it.
+            With several classes, each class's statistics are kept in a
+            separate file (see `stats_path_for`).
+        freeze_cohort_stats:  Scale the maps by the statistics in
+            `cohort_stats_path` as they are, without adding the slides to
+            them.
+        stats_only:  Only add the slides to the cohort statistics (and save
+            them), without rendering any heatmaps.
+        workers:  Number of threads to read the maps and render the slides'
+            heatmaps with.
+        quiet:  Neither print the scores' range nor show progress (e.g. when
+            rendering slides one by one).
+        render_options:  Colour maps and alphas (see `render_heatmaps`).
+
+    Returns:
+        The directories the heatmaps were written to (one per slide and
+        class), if any.
+    """
+    assert slides, "no slides to render"
+    classes = read_maps(next(iter(slides.values()))[2]).classes.tolist()
+    per_class = len(true_classes) > 1 or list(true_classes) == ["all"]
+    if list(true_classes) == ["all"]:
+        true_classes = classes
+    for true_class in true_classes:
+        # (checked even with -O, as rendering the wrong class goes unnoticed)
+        if true_class not in classes:
+            raise ValueError(
+                f"{true_class} not a target of the model! "
+                f"(Did you mean any of {classes}?)"
+            )
+    assert cohort_stats_path or not freeze_cohort_stats, \
+        "frozen cohort statistics need a statistics file."
+
+    # we operate in two steps: we first collect all attention values / scores,
+    # the entirety of which we then calculate our scaling parameters from.
+    # Only then we output the actual maps.
+    # The values are summarised in (mergeable) sketches, which can be extended
+    # by later runs
+    stats_paths: Dict[str, Optional[Path]] = {
+        true_class: stats_path_for(cohort_stats_path, true_class)
+        if cohort_stats_path and per_class
+        else cohort_stats_path
+        for true_class in true_classes
+    }
+    cohort_stats: Dict[str, CohortStats] = {}
+    # (the statistics are read, extended and saved under a lock, so runs
+    # extending the same cohort at the same time do not lose each other's
+    # slides;  the locks are taken in order, so they cannot deadlock)
+    with ExitStack() as stats_locks:
+        if not freeze_cohort_stats:
+            for stats_path in sorted(
+                {path for path in stats_paths.values() if path}
+            ):
+                stats_locks.enter_context(
+                    FileLock(stats_path.with_name(stats_path.name + ".lock"))
+                )
+        for true_class in true_classes:
+            meta = {**cohort_meta, "true_class": true_class}
+            stats_path = stats_paths[true_class]
+            if stats_path and stats_path.exists():
+                cohort_stats[true_class] = CohortStats.load(stats_path)
+                if cohort_stats[true_class].meta != meta:
+                    raise RuntimeError(
+                        f"cohort statistics in {stats_path} were calculated "
+                        f"for {cohort_stats[true_class].meta}, not {meta}"
+                    )
+            elif freeze_cohort_stats:
+                raise RuntimeError(
+                    f"no frozen cohort statistics in {stats_path}"
+                )
+            else:
+                cohort_stats[true_class] = CohortStats(len(classes), meta)
+
+        # (frozen statistics are used as they are;  slides are added in
+        # order, so the statistics do not depend on the number of workers)
+        with futures.ThreadPoolExecutor(workers) as executor:
+            for slide_id, maps in executor.map(
+                lambda slide: (slide[0], read_maps(slide[2])),
+                [] if freeze_cohort_stats else slides.values(),
+            ):
+                # mask out background values, then linearize them
+                attentions = maps.attention[maps.mask]
+                for true_class in true_classes:
+                    true_class_idx = (maps.classes == true_class).argmax()
+                    cohort_stats[true_class].add_slide(
+                        slide_id,
+                        attentions,
+                        maps.scores[true_class_idx][maps.mask],
+                    )
+
+        for true_class in true_classes:
+            if (stats_path := stats_paths[true_class]) and \
+                    not freeze_cohort_stats:
+                stats_path.parent.mkdir(parents=True, exist_ok=True)
+                cohort_stats[true_class].save(stats_path)
+
+    scaling: Dict[str, Dict[str, float]] = {}
+    for true_class in true_classes:
+        stats = cohort_stats[true_class]
+        if stats_only:
+            continue
+
+        # now we can use all of the features to calculate the scaling factors
+        att_lower, att_upper = stats.att_bounds(
+            att_lower_threshold, att_upper_threshold
+        )
+
+        # THIS SOMETIMES SEEMS UNHELPFUL AT THE MOMENT -
+        # MOST TRUE SCORES ARE ONE SIDE OF 0.5
+        scale_factor = stats.score_scale_factor(score_threshold)
+
+        # For scaling cmap
+        min_true_score = stats.score.min
+        max_true_score = stats.score.max
+#        midrange_true_score = (min_true_score + max_true_score) / 2
+#        half_range_cmap = \
+#            max(abs(min_true_score - 0.5) - 0.5, abs(max_true_score) - 0.5)
+
+        if not quiet:
+            if per_class:
+                print(f"\n{true_class}:")
+            print('\nMin true score: {:.2f}'.format(min_true_score))
+            print('\nMax true score: {:.2f}'.format(max_true_score))
+
+        scaling[true_class] = {
+            "att_lower": att_lower,
+            "att_upper": att_upper,
+            "score_mean": stats.score.mean,
+            "score_std": stats.score.std,
+        }
+
+    if stats_only:
+        return []
+
+    def render_slide(slide_name: str) -> List[Path]:
+        _, slide_cache_dir, maps_path = slides[slide_name]
+        maps = read_maps(maps_path)
+        slide_im_vis = saturate_fov(read_fov(slide_cache_dir))
+        slide_outdirs = []
+        for true_class in true_classes:
+            slide_outdir = (
+                output_path / true_class if per_class else output_path
+            ) / slide_name
+            slide_outdir.mkdir(parents=True, exist_ok=True)
+            slide_outdirs.append(slide_outdir)
+
+            true_class_idx = (maps.classes == true_class).argmax()
+            render_heatmaps(
+                slide_outdir,
+                slide_im_vis,
+                maps.attention,
+                maps.scores[true_class_idx],
+                maps.mask,
+                **scaling[true_class],
+                **render_options,
+            )
+        return slide_outdirs
+
+    if not quiet:
+        print("Writing heatmaps...")
+    with futures.ThreadPoolExecutor(workers) as executor:
+        return [
+            slide_outdir
+            for slide_outdirs in tqdm(
+                executor.map(render_slide, slides),
+                total=len(slides),
+                leave=False,
+                disable=quiet,
+            )
+            for slide_outdir in slide_outdirs
+        ]
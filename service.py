@@ -0,0 +1,216 @@
+"""Service keeping the models resident to create heatmaps on demand.
+
+Importing torch & co. and loading the backbone and MIL models takes longer
+than creating the heatmaps of a small FOV.  In service mode, this is done
+only once;  jobs are then taken over HTTP, on a TCP port or a Unix socket:
+
+    POST /jobs          Submits a job (a JSON object).  Returns its id and
+                        status.  With `?wait=1`, only returns once the job
+                        has finished, along with its result.
+    GET /jobs/ID        Returns the status of a job, and its result (or
+                        error) once it has finished.
+
+Jobs are queued and run by a fixed number of workers.  If the queue is full,
+further jobs are rejected (with status 503) instead of piling up.
+"""
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+
+# number of finished jobs to remember the results of
+MAX_FINISHED_JOBS = 1024
+
+
+class Job:
+    def __init__(self, spec: Dict[str, Any]) -> None:
+        self.id = uuid.uuid4().hex
+        self.spec = spec
+        self.status = "queued"
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        self.done = threading.Event()
+
+    def as_dict(self) -> Dict[str, Any]:
+        info: Dict[str, Any] = {"id": self.id, "status": self.status}
+        if self.result is not None:
+            info["result"] = self.result
+        if self.error is not None:
+            info["error"] = self.error
+        return info
+
+
+class JobQueue:
+    """Runs jobs with a fixed number of worker threads.
+
+    Args:
+        run:  Runs a job, returning its (JSON-serialisable) result.
+        workers:  Number of jobs to run at the same time.
+        max_queued:  Number of jobs which may wait to be run.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[Dict[str, Any]], Dict[str, Any]],
+        *,
+        workers: int = 1,
+        max_queued: int = 16,
+    ) -> None:
+        assert workers > 0, "there has to be at least one worker."
+        self.run = run
+        self._queue: "queue.Queue[Job]" = queue.Queue(maxsize=max_queued)
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, spec: Dict[str, Any]) -> Job:
+        """Queues a job.
+
+        Raises:
+            queue.Full:  If there are too many jobs waiting already.
+        """
+        job = Job(spec)
+        self._queue.put_nowait(job)
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            try:
+                job.result = self.run(job.spec)
+                job.status = "done"
+            except Exception as e:
+                traceback.print_exc()
+                job.error = f"{type(e).__name__}: {e}"
+                job.status = "failed"
+            job.finished_at = time.time()
+            job.done.set()
+            self._forget_old_jobs()
+
+    def _forget_old_jobs(self) -> None:
+        with self._lock:
+            finished = sorted(
+                (job for job in self._jobs.values() if job.finished_at),
+                key=lambda job: job.finished_at,  # type: ignore
+            )
+            for job in finished[:-MAX_FINISHED_JOBS]:
+                del self._jobs[job.id]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/jobs":
+            return self._reply(404, {"error": f"no such resource: {url.path}"})
+        try:
+            spec = json.loads(
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            )
+            if not isinstance(spec, dict):
+                raise ValueError("jobs have to be JSON objects.")
+            if self.server.validate is not None:
+                self.server.validate(spec)
+        except ValueError as e:
+            return self._reply(400, {"error": f"invalid job: {e}"})
+        try:
+            job = self.server.jobs.submit(spec)
+        except queue.Full:
+            return self._reply(503, {"error": "too many jobs queued"})
+        if parse_qs(url.query).get("wait", ["0"])[0] not in ("", "0"):
+            job.done.wait()
+        self._reply(200 if job.done.is_set() else 202, job.as_dict())
+
+    def do_GET(self) -> None:
+        path = urlsplit(self.path).path
+        if not path.startswith("/jobs/") or not (
+            job := self.server.jobs.get(path[len("/jobs/"):])
+        ):
+            return self._reply(404, {"error": f"no such resource: {path}"})
+        self._reply(200, job.as_dict())
+
+    def _reply(self, status: int, body: Dict[str, Any]) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self) -> str:
+        # (clients of Unix sockets have no address)
+        return super().address_string() if self.client_address else "local"
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    jobs: JobQueue
+    validate: Optional[Callable[[Dict[str, Any]], None]]
+
+
+class _UnixServer(_Server):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self) -> None:
+        # (HTTPServer's expects a host and port)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+
+def serve(
+    address: str,
+    run: Callable[[Dict[str, Any]], Dict[str, Any]],
+    *,
+    validate: Optional[Callable[[Dict[str, Any]], None]] = None,
+    workers: int = 1,
+    max_queued: int = 16,
+) -> None:
+    """Takes jobs over HTTP until interrupted.
+
+    Args:
+        address:  `[HOST:]PORT` to listen on, or the path of a Unix socket
+            (containing a `/`).  The host defaults to localhost.
+        run:  Runs a job (see `JobQueue`).
+        validate:  Checks a job before it is queued, raising a ValueError if
+            it is invalid.
+        workers, max_queued:  See `JobQueue`.
+    """
+    server: _Server
+    if "/" in address:
+        if os.path.exists(address):
+            # left behind by an earlier service
+            os.unlink(address)
+        server = _UnixServer(address, _Handler)  # type: ignore
+    else:
+        host, _, port = address.rpartition(":")
+        server = _Server((host or "localhost", int(port)), _Handler)
+    server.jobs = JobQueue(run, workers=workers, max_queued=max_queued)
+    server.validate = validate
+    print(f"Taking jobs on {address}...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if "/" in address:
+            os.unlink(address)
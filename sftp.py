@@ -1,28 +1,69 @@
 #%%
+import atexit
+from concurrent import futures
+from contextlib import contextmanager
 from getpass import getpass
+import json
 import os
 from pathlib import Path
+import posixpath
 import re
-from typing import MutableMapping, Tuple
+import socket
+import threading
+import time
+from typing import (
+    TYPE_CHECKING, Any, Callable, ContextManager, Dict, Iterable, Iterator,
+    List, Mapping, MutableMapping, Optional, Set, Tuple,
+)
 from urllib.parse import ParseResult
-import paramiko
+
+if TYPE_CHECKING:
+    import paramiko
+
+from locking import FileLock
+
+
+# downloads are split into segments of this size, which are fetched by
+# several streams at once and are the unit interrupted downloads resume at
+SEGMENT_SIZE = 2**24
+# size of the reads requested at once (pipelined by paramiko)
+READ_SIZE = 2**20
+# seconds without data after which a download stream reconnects, and how
+# often it may do so in a row
+STALL_TIMEOUT = 10
+MAX_RETRIES = 3
 
 # %%
-def get_wsi(url: ParseResult, *, cache_dir: Path) -> Path:
+def get_wsi(
+    url: ParseResult,
+    *,
+    cache_dir: Path,
+    streams: int = 4,
+    keep: Optional[Callable[[Path], Path]] = None,
+) -> Path:
+    """Returns a local copy of a WSI, downloading it if necessary.
+
+    Remote WSIs are downloaded into `cache_dir` with several concurrent
+    streams, each reading different segments of the file.  Interrupted
+    downloads are resumed from the segments already downloaded.
+
+    Args:
+        streams:  Number of connections to download a remote WSI with.
+        keep:  Called with the downloaded copy while no other process may
+            download to the same path (e.g. to hash it and move it
+            elsewhere).  Returns the path of the copy to use.
+    """
     if not url.scheme:  # local file
         return Path(url.path)
     elif url.scheme == "sftp":
-        username, host, port = _parse_netloc(url.netloc)
-        password = _get_password_for_netloc(url.netloc)
-
-        transport = paramiko.Transport((host, port))
-        transport.connect(None, username, password)
-        print("Authentication successful")
-        with paramiko.SFTPClient.from_transport(transport) as sftp:  # type: ignore
-            assert sftp is not None
+        with _connect(url) as sftp:
             remote_stats = sftp.stat(url.path)
 
-            cached_wsi_path = cache_dir / Path(url.path).name
+        cached_wsi_path = cache_dir / Path(url.path).name
+        # only one process may download to the same path at a time; others
+        # wait for it and then reuse its copy
+        lock_path = cache_dir / "locks" / f"{cached_wsi_path.name}.lock"
+        with FileLock(lock_path):
             # do we have a cached copy?
             if (
                 cached_wsi_path.exists()
@@ -32,28 +73,318 @@ def get_wsi(url: ParseResult, *, cache_dir: Path) -> Path:
                 and remote_stats.st_mtime
                 and remote_stats.st_mtime <= cached_stats.st_mtime
             ):  # remote file not newer
-                return cached_wsi_path  # yes, we have a good copy
+                # yes, we have a good copy
+                return keep(cached_wsi_path) if keep else cached_wsi_path
+
+            # if all else fails, download it (to a partial file first, so an
+            # interrupted download is never mistaken for a good copy)
+            part_path = cached_wsi_path.with_name(
+                cached_wsi_path.name + ".part"
+            )
+            _download(
+                url,
+                part_path,
+                size=remote_stats.st_size or 0,
+                mtime=remote_stats.st_mtime or 0,
+                streams=streams,
+            )
+            part_path.replace(cached_wsi_path)
+            return keep(cached_wsi_path) if keep else cached_wsi_path
+    else:
+        raise RuntimeError(f"unsupported scheme: {url.scheme}")
+
+
+def read_wsi(url: ParseResult, *, streams: int = 4) -> bytearray:
+    """Reads a remote WSI into memory, without keeping a local copy.
+
+    The WSI is read with several concurrent streams like in `get_wsi`.
+
+    Args:
+        streams:  Number of connections to read the WSI with.
+    """
+    if url.scheme != "sftp":
+        raise RuntimeError(f"unsupported scheme: {url.scheme}")
+    with _connect(url) as sftp:
+        size = sftp.stat(url.path).st_size or 0
+    data = bytearray(size)
+    view = memoryview(data)
+
+    def write(offset: int, chunk: bytes) -> None:
+        view[offset:offset + len(chunk)] = chunk
+
+    _fetch_segments(
+        url,
+        list(range(-(-size // SEGMENT_SIZE))),
+        size=size,
+        streams=streams,
+        write=write,
+    )
+    return data
+
+
+def _download(
+    url: ParseResult, part_path: Path, *, size: int, mtime: int, streams: int
+) -> None:
+    # downloads a remote file segment by segment,
+    # recording the segments downloaded so far next to the partial file, so
+    # an interrupted download of the same version of the file can be resumed
+    progress_path = part_path.with_name(part_path.name + ".json")
+    version = {"size": size, "mtime": mtime, "segment_size": SEGMENT_SIZE}
+    done: Set[int] = set()
+    if part_path.exists() and progress_path.exists():
+        with open(progress_path) as fp:
+            progress = json.load(fp)
+        if progress["version"] == version:
+            done = set(progress["done"])
+    n_segments = -(-size // SEGMENT_SIZE)
+    if done:
+        print(
+            f"Resuming download of {url.geturl()}"
+            f" ({len(done)} / {n_segments} segments done)"
+        )
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+    lock = threading.Lock()
+
+    def record(segment: int) -> None:
+        # (only segments which are on disk are recorded)
+        os.fsync(fd)
+        with lock:
+            done.add(segment)
+            tmp_path = progress_path.with_name(progress_path.name + ".tmp")
+            with open(tmp_path, "w") as fp:
+                json.dump({"version": version, "done": sorted(done)}, fp)
+            tmp_path.replace(progress_path)
+
+    try:
+        os.ftruncate(fd, size)
+        _fetch_segments(
+            url,
+            [i for i in range(n_segments) if i not in done],
+            size=size,
+            streams=streams,
+            write=lambda offset, chunk: os.pwrite(fd, chunk, offset),
+            on_segment=record,
+        )
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    progress_path.unlink(missing_ok=True)
+
+
+def _fetch_segments(
+    url: ParseResult,
+    todo: List[int],
+    *,
+    size: int,
+    streams: int,
+    write: Callable[[int, bytes], Any],
+    on_segment: Optional[Callable[[int], None]] = None,
+) -> None:
+    # fetches segments of a remote file with several streams, passing each
+    # chunk read to `write` (with its offset) and each completed segment to
+    # `on_segment`
+    def fetch(segments: List[int]) -> None:
+        retries = 0
+        while segments:
+            try:
+                with _connect(url) as sftp, \
+                        sftp.open(url.path, "rb") as remote:
+                    # (raises a timeout instead of hanging on stalls)
+                    channel = sftp.get_channel()
+                    assert channel is not None
+                    channel.settimeout(STALL_TIMEOUT)
+                    while segments:
+                        start = segments[0] * SEGMENT_SIZE
+                        end = min(start + SEGMENT_SIZE, size)
+                        chunks = [
+                            (offset, min(READ_SIZE, end - offset))
+                            for offset in range(start, end, READ_SIZE)
+                        ]
+                        for (offset, _), data in \
+                                zip(chunks, remote.readv(chunks)):
+                            write(offset, data)
+                        if on_segment is not None:
+                            on_segment(segments[0])
+                        segments.pop(0)
+                        retries = 0
+            except Exception as e:
+                # (the failed connection is closed;  the stream continues
+                # with the segment it was at on a new one)
+                if (retries := retries + 1) > MAX_RETRIES:
+                    raise
+                print(
+                    f"Reconnecting to read {url.geturl()}"
+                    f" ({type(e).__name__}: {e})"
+                )
+                time.sleep(retries)
+
+    # (each stream takes every n-th of the segments)
+    streams = max(1, min(streams, len(todo)))
+    with futures.ThreadPoolExecutor(streams) as executor:
+        for fetched in [
+            executor.submit(fetch, todo[i::streams]) for i in range(streams)
+        ]:
+            fetched.result()
+
+
+def source_identity(url: ParseResult) -> str:
+    """Identifies the current version of a WSI without reading it.
+
+    The identity changes whenever the file's location, size or modification
+    time do, so it can be used to memoize information about its content.
+    """
+    if not url.scheme:  # local file
+        path = Path(url.path).resolve()
+        stats = os.stat(path)
+        return f"file://{path}:{stats.st_size}:{stats.st_mtime_ns}"
+    elif url.scheme == "sftp":
+        with _connect(url) as sftp:
+            stats = sftp.stat(url.path)
+        return f"{url.geturl()}:{stats.st_size}:{stats.st_mtime}"
+    else:
+        raise RuntimeError(f"unsupported scheme: {url.scheme}")
 
-            sftp.get(remotepath=str(url.path), localpath=str(cached_wsi_path))
-            # if all else fails, download it
-            return cached_wsi_path
+
+def slide_identity(url: ParseResult) -> str:
+    """Identifies a WSI by its location, however its URL was written.
+
+    Relative and absolute paths of a local file (or ones through symlinks)
+    give the same identity, as do remote URLs with different usernames or
+    with and without the default port.  Unlike `source_identity`, it does
+    not change with the file's content.
+    """
+    if not url.scheme:  # local file
+        return str(Path(url.path).resolve())
+    elif url.scheme == "sftp":
+        _, host, port = _parse_netloc(url.netloc)
+        return f"sftp://{host}:{port}{posixpath.normpath(url.path)}"
     else:
         raise RuntimeError(f"unsupported scheme: {url.scheme}")
 
 
+class _ConnectionPool:
+    """Keeps SFTP connections open for reuse, by netloc.
+
+    Args:
+        max_idle:  Number of idle connections to keep per netloc.
+    """
+
+    def __init__(self, max_idle: int = 8) -> None:
+        self.max_idle = max_idle
+        self._idle: Dict[
+            str, List[Tuple["paramiko.Transport", "paramiko.SFTPClient"]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connect(self, url: ParseResult) -> Iterator["paramiko.SFTPClient"]:
+        """Borrows a connection to a URL's netloc, opening it if necessary.
+
+        Connections are only returned to the pool if they were used without
+        errors.
+        """
+        connection = None
+        with self._lock:
+            idle = self._idle.setdefault(url.netloc, [])
+            while idle and not connection:
+                connection = idle.pop()
+                if not connection[0].is_active():
+                    # (closed by the server in the meantime)
+                    connection = None
+        transport, sftp = connection or self._open(url.netloc)
+        try:
+            yield sftp
+        except BaseException:
+            transport.close()
+            raise
+        with self._lock:
+            if len(idle) < self.max_idle:
+                idle.append((transport, sftp))
+                return
+        transport.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for idle in self._idle.values():
+                for transport, _ in idle:
+                    transport.close()
+            self._idle.clear()
+
+    @staticmethod
+    def _open(
+        netloc: str,
+    ) -> Tuple["paramiko.Transport", "paramiko.SFTPClient"]:
+        # (paramiko is only imported when needed, as it takes a while)
+        import paramiko
+
+        username, host, port = _parse_netloc(netloc)
+        password = _get_password_for_netloc(netloc)
+
+        sock = socket.create_connection((host, port))
+        # (without, reads paramiko cannot pipeline wait for delayed ACKs)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.connect(None, username, password)
+            # (keeps idle connections from being dropped)
+            transport.set_keepalive(30)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            assert sftp is not None
+        except BaseException:
+            transport.close()
+            raise
+        print("Authentication successful")
+        return transport, sftp
+
+
+_pool = _ConnectionPool()
+atexit.register(_pool.close)
+
+
+def _connect(url: ParseResult) -> "ContextManager[paramiko.SFTPClient]":
+    return _pool.connect(url)
+
+
+_password_lock = threading.Lock()
+# passwords by netloc, asked for once per process
+_passwords: Dict[str, str] = {}
+
+
+def ask_passwords(urls: Iterable[ParseResult]) -> Dict[str, str]:
+    """Asks for the passwords of the hosts of remote URLs (once per host).
+
+    Returns:
+        The passwords by netloc (see `remember_passwords`).
+    """
+    return {
+        url.netloc: _get_password_for_netloc(url.netloc)
+        for url in urls
+        if url.scheme == "sftp"
+    }
+
+
+def remember_passwords(passwords: Mapping[str, str]) -> None:
+    """Uses the given passwords (by netloc) instead of asking for them."""
+    with _password_lock:
+        _passwords.update(passwords)
+
+
 def _get_password_for_netloc(
-    netloc: str, netloc_passwds: MutableMapping[str, str] = {}
+    netloc: str, netloc_passwds: MutableMapping[str, str] = _passwords
 ) -> str:
     # absolutely disgusting use of a "static variable" in the form of a default argument
     # don't try this at home
     # (netloc_passwds persists between calls)
 
-    if netloc not in netloc_passwds:
-        passwd = getpass(f"Enter password for {netloc}: ")
-        netloc_passwds[netloc] = passwd
-        return passwd
-    else:
-        return netloc_passwds[netloc]
+    # (connections are opened by several threads, which should not all ask)
+    with _password_lock:
+        if netloc not in netloc_passwds:
+            passwd = getpass(f"Enter password for {netloc}: ")
+            netloc_passwds[netloc] = passwd
+            return passwd
+        else:
+            return netloc_passwds[netloc]
 
 
 def _parse_netloc(netloc: str) -> Tuple[str, str, int]:
@@ -0,0 +1,184 @@
+"""Splitting a cohort across several runs, e.g. on several machines.
+
+Each run (rank) creates the maps of every n-th slide.  As the heatmaps are
+normalised by statistics of the whole cohort, the ranks exchange the
+statistics of their shards through a directory on a shared file system:
+
+    DIR/rank-R/         statistics of shard R (see `render.render_cohort`)
+    DIR/rank-R.done     marks them as complete
+    DIR/merged/         statistics of the whole cohort
+    DIR/merged.done     marks them as complete
+    DIR/rank-R.failed   marks that rank R failed (see `marking_failure`),
+                        making the ranks waiting for it fail as well
+
+Once all shards' statistics are in, rank 0 merges them (see
+`sketches.CohortStats.merge`) and every rank renders its own shard with the
+merged statistics.  The means and standard deviations are merged exactly,
+the quantiles with the sketches' usual error bounds.
+
+The markers record an id of the run, so stale directories of other runs are
+recognised;  use a new directory for every run all the same.
+"""
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from sketches import CohortStats
+
+
+T = TypeVar("T")
+
+# seconds between checks whether the other ranks are done
+POLL_INTERVAL = 1.0
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """Parses a shard given as `RANK/WORLD_SIZE` (e.g. `0/4`)."""
+    rank, _, world_size = spec.partition("/")
+    try:
+        shard = int(rank), int(world_size)
+    except ValueError:
+        raise ValueError(f"invalid shard {spec!r}; expected RANK/WORLD_SIZE")
+    if not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"rank {shard[0]} not in [0, {shard[1]})")
+    return shard
+
+
+def shard_of(items: Sequence[T], rank: int, world_size: int) -> List[T]:
+    """Returns the items making up a rank's shard."""
+    return list(items[rank::world_size])
+
+
+def rank_stats_dir(shard_dir: Path, rank: int) -> Path:
+    return shard_dir / f"rank-{rank}"
+
+
+@contextmanager
+def marking_failure(
+    shard_dir: Path, rank: int, *, run_id: str
+) -> Iterator[None]:
+    """Marks a rank as failed if the block raises an exception.
+
+    Ranks waiting for the failed rank (see `gather_cohort_stats`) then fail
+    as well instead of waiting forever.
+    """
+    try:
+        yield
+    except BaseException as e:
+        _mark_done(
+            shard_dir / f"rank-{rank}.failed",
+            f"{run_id}\n{type(e).__name__}: {e}",
+        )
+        raise
+
+
+def gather_cohort_stats(
+    shard_dir: Path,
+    rank: int,
+    world_size: int,
+    *,
+    run_id: str,
+    base: Optional[Path] = None,
+) -> Path:
+    """Marks a rank's shard statistics complete and gathers all shards'.
+
+    Rank 0 merges the statistics of all shards, and the other ranks wait for
+    it to.  Blocks until all ranks have called this, or raises a
+    RuntimeError if one of them failed (see `marking_failure`).
+
+    Args:
+        shard_dir:  The directory shared by the ranks.  The rank's
+            statistics have to be in `rank_stats_dir(shard_dir, rank)`.
+        run_id:  Identifies the run, e.g. by a fingerprint of its slides and
+            options.  It has to be the same for all ranks.
+        base:  Statistics of an existing cohort to add the shards to (see
+            `--cohort-stats`).  Rank 0 also saves the merged statistics to
+            it.  The shards' statistics have to be named like it.
+
+    Returns:
+        The merged statistics, named like the shards'.
+    """
+    _mark_done(shard_dir / f"rank-{rank}.done", run_id)
+    merged_dir = shard_dir / "merged"
+    if rank == 0:
+        _wait_for(
+            [shard_dir / f"rank-{r}.done" for r in range(world_size)],
+            run_id,
+            shard_dir=shard_dir,
+        )
+        with marking_failure(shard_dir, rank, run_id=run_id):
+            _merge_shards(shard_dir, world_size, merged_dir, base)
+        _mark_done(shard_dir / "merged.done", run_id)
+    else:
+        _wait_for(
+            [shard_dir / "merged.done"], run_id, shard_dir=shard_dir
+        )
+    return merged_dir / (base.name if base else "cohort-stats.json")
+
+
+def _merge_shards(
+    shard_dir: Path, world_size: int, merged_dir: Path, base: Optional[Path]
+) -> None:
+    merged_dir.mkdir(parents=True, exist_ok=True)
+    if base:
+        base.parent.mkdir(parents=True, exist_ok=True)
+    # (the shards have statistics for the same models and classes, unless
+    # they had no slides at all)
+    names = sorted({
+        path.name
+        for r in range(world_size)
+        for path in rank_stats_dir(shard_dir, r).glob("*")
+        # (skipping statistics being saved and their locks)
+        if not path.name.endswith((".tmp", ".lock"))
+    })
+    for name in names:
+        merged = None
+        if base and (base_path := base.with_name(name)).exists():
+            merged = CohortStats.load(base_path)
+        for r in range(world_size):
+            if not (path := rank_stats_dir(shard_dir, r) / name).exists():
+                continue
+            stats = CohortStats.load(path)
+            if merged is None:
+                merged = stats
+            elif stats.slides <= merged.slides:
+                # (already added to the existing cohort by an earlier run)
+                continue
+            else:
+                merged.merge(stats)
+        assert merged is not None
+        merged.save(merged_dir / name)
+        if base:
+            merged.save(base.with_name(name))
+
+
+def _mark_done(path: Path, text: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    tmp_path.write_text(text)
+    tmp_path.replace(path)
+
+
+def _wait_for(
+    markers: Sequence[Path], run_id: str, *, shard_dir: Path
+) -> None:
+    waiting = False
+    for marker in markers:
+        while not marker.exists():
+            for failed in shard_dir.glob("rank-*.failed"):
+                failed_id, _, error = failed.read_text().partition("\n")
+                if failed_id == run_id:
+                    raise RuntimeError(
+                        f"{failed.name[:-len('.failed')]} failed ({error})"
+                    )
+            if not waiting:
+                print(f"Waiting for the other shards in {marker.parent}...")
+                waiting = True
+            time.sleep(POLL_INTERVAL)
+        if (marker_id := marker.read_text()) != run_id:
+            raise RuntimeError(
+                f"{marker} belongs to another run ({marker_id}, not"
+                f" {run_id}); use a new shard directory for every run"
+            )
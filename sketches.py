@@ -0,0 +1,280 @@
+"""Mergeable sketches of cohort statistics.
+
+The scaling of attention / score maps depends on quantiles and moments of the
+(foreground) values of all slides in a cohort.  Instead of concatenating all
+values to calculate these, we summarise each slide's values in small sketches
+which can be merged and saved, so that memory use does not grow with the
+cohort size and cohorts can be extended in later runs.
+"""
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+
+class MomentSketch:
+    """Count, mean, variance and extrema of a stream of values.
+
+    Uses Chan et al.'s parallel update, so merging is exact (up to floating
+    point error).
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.  # sum of squared deviations from the mean
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if not values.size:
+            return
+        other = MomentSketch()
+        other.count = values.size
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean)**2).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        self.merge(other)
+
+    def merge(self, other: "MomentSketch") -> None:
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def std(self) -> float:
+        """Unbiased standard deviation (like `torch.std`)."""
+        return float(np.sqrt(self.m2 / (self.count - 1))) \
+            if self.count > 1 else float("nan")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "MomentSketch":
+        sketch = cls()
+        sketch.count = d["count"]
+        sketch.mean, sketch.m2 = d["mean"], d["m2"]
+        sketch.min, sketch.max = d["min"], d["max"]
+        return sketch
+
+
+class QuantileSketch:
+    """KLL quantile sketch.
+
+    Values are kept in a hierarchy of compactors, the items in level h each
+    standing for 2**h values.  Whenever a level exceeds its capacity, it is
+    sorted and every other item is promoted to the next level.  Quantiles are
+    exact as long as no compaction has taken place, and otherwise have a
+    normalised rank error of roughly 2 / k.  Extreme quantiles (0 and 1) are
+    always exact.
+
+    Args:
+        k:  Capacity of the top level; determines the accuracy.
+        seed:  Seed for the random choice of items to promote.
+    """
+
+    def __init__(self, k: int = 4096, seed: int = 0) -> None:
+        self.k = k
+        self.levels: List[np.ndarray] = [np.empty(0)]
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3)**depth)))
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if not values.size:
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                # capacities of the lower levels shrink with a new level on top
+                self.levels.append(np.empty(0))
+            items = np.sort(items)
+            # an odd item out stays behind
+            keep = items[len(items) - len(items) % 2:]
+            promoted = items[self._rng.integers(2):len(items) - len(keep):2]
+            self.levels[level] = keep
+            self.levels[level + 1] = np.concatenate(
+                [self.levels[level + 1], promoted]
+            )
+            level = 0
+
+    @property
+    def count(self) -> int:
+        return sum(len(level_items) << level
+                   for level, level_items in enumerate(self.levels))
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return float("nan")
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        if len(self.levels) == 1:
+            # nothing has been compacted yet
+            return float(np.quantile(self.levels[0], q))
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(len(level_items), 1 << level)
+            for level, level_items in enumerate(self.levels)
+        ])
+        order = np.argsort(items)
+        ranks = np.cumsum(weights[order])
+        idx = np.searchsorted(ranks, q * ranks[-1])
+        return float(items[order][min(idx, len(items) - 1)])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "k": self.k,
+            "levels": [items.tolist() for items in self.levels],
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "QuantileSketch":
+        sketch = cls(k=d["k"])
+        sketch.levels = [np.asarray(items, dtype=np.float64)
+                         for items in d["levels"]]
+        sketch.min, sketch.max = d["min"], d["max"]
+        return sketch
+
+
+class CohortStats:
+    """Statistics for scaling attention / score maps across a cohort.
+
+    Args:
+        no_classes:  Number of classes of the MIL model.  Scores are
+            centred around 1 / no_classes for the score scale factor.
+        meta:  Parameters the statistics depend on (e.g. model and target).
+            Statistics with different parameters cannot be merged.
+    """
+
+    def __init__(
+        self, no_classes: int, meta: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self.no_classes = no_classes
+        self.meta = meta or {}
+        self.slides: Set[str] = set()
+        self.attention = QuantileSketch()
+        self.score_deviation = QuantileSketch()
+        self.score = MomentSketch()
+
+    def add_slide(
+        self, slide: str, attentions: np.ndarray, true_scores: np.ndarray
+    ) -> bool:
+        """Adds a slide's (foreground) attention and true class scores.
+
+        Slides are identified by their location (see `sftp.slide_identity`),
+        so a slide given by another path is not added twice, and one whose
+        content changed (e.g. a FOV acquired again) is not added again
+        either:  its first version's values cannot be taken out of the
+        sketches.
+
+        Returns:
+            False if the slide was already part of the statistics (in which
+            case it is not added again).
+        """
+        if slide in self.slides:
+            return False
+        true_scores = np.asarray(true_scores, dtype=np.float64)
+        self.attention.update(attentions)
+        self.score_deviation.update(np.abs(true_scores - 1 / self.no_classes))
+        self.score.update(true_scores)
+        self.slides.add(slide)
+        return True
+
+    def merge(self, other: "CohortStats") -> None:
+        if other.meta != self.meta or other.no_classes != self.no_classes:
+            raise RuntimeError(
+                f"cannot merge statistics for {other.meta} into ones for "
+                f"{self.meta}"
+            )
+        if overlap := self.slides & other.slides:
+            raise RuntimeError(
+                f"slides {sorted(overlap)} are part of both statistics"
+            )
+        self.attention.merge(other.attention)
+        self.score_deviation.merge(other.score_deviation)
+        self.score.merge(other.score)
+        self.slides |= other.slides
+
+    def att_bounds(
+        self, lower_q: float, upper_q: float
+    ) -> Tuple[float, float]:
+        """Attention values at the lower / upper scaling quantiles."""
+        return self.attention.quantile(lower_q), \
+            self.attention.quantile(upper_q)
+
+    def score_scale_factor(self, q: float) -> float:
+        return self.score_deviation.quantile(q) * 2
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "no_classes": self.no_classes,
+            "meta": self.meta,
+            "slides": sorted(self.slides),
+            "attention": self.attention.to_dict(),
+            "score_deviation": self.score_deviation.to_dict(),
+            "score": self.score.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "CohortStats":
+        stats = cls(d["no_classes"], d["meta"])
+        stats.slides = set(d["slides"])
+        stats.attention = QuantileSketch.from_dict(d["attention"])
+        stats.score_deviation = QuantileSketch.from_dict(d["score_deviation"])
+        stats.score = MomentSketch.from_dict(d["score"])
+        return stats
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(self.to_dict(), fp)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "CohortStats":
+        with open(path) as fp:
+            return cls.from_dict(json.load(fp))
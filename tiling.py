@@ -0,0 +1,252 @@
+"""Tiled inference of fully convolutional backbones.
+
+Running a whole FOV through the backbone in one go needs a lot of memory,
+while naively slicing the FOV leaves seams in the feature map, as features
+near the slice edges see zero padding instead of their actual neighbours.
+Here, we split the FOV into tiles which overlap by (at least) the receptive
+field radius of the backbone.  Each tile is then passed through the network,
+the features influenced by the tile edges are cropped off and the remaining
+ones are stitched into the same feature map a single pass would have
+produced.
+"""
+from typing import Callable, Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+# conservative estimate of the peak number of bytes needed per input pixel
+# when passing an (fp32) image through a ResNet50 in inference mode
+RESNET50_BYTES_PER_PIXEL = 256
+
+
+def receptive_field(model: nn.Module) -> Tuple[int, int]:
+    """Calculates the receptive field radius and total stride of a model.
+
+    Only the main path of the network is considered, i.e. `downsample`
+    branches of residual blocks are skipped, as their receptive fields are
+    always contained in the main path's.
+
+    Returns:
+        The receptive field radius (in input pixels) and the total stride of
+        the model.
+    """
+    radius, stride = 0, 1
+    for name, module in model.named_modules():
+        if "downsample" in name:
+            continue
+        # convolutions, poolings and their (e.g. folded) stand-ins
+        if hasattr(module, "kernel_size") and hasattr(module, "stride"):
+            kernel_size = _first(module.kernel_size)
+            dilation = _first(getattr(module, "dilation", 1))
+            radius += (kernel_size - 1) // 2 * dilation * stride
+            stride *= _first(module.stride)
+    return radius, stride
+
+
+def _first(x) -> int:
+    return x[0] if isinstance(x, tuple) else x
+
+
+def halo_for(model: nn.Module) -> Tuple[int, int]:
+    """Calculates the tile overlap needed for seamless tiled inference.
+
+    Returns:
+        The halo (the receptive field radius rounded up to a multiple of the
+        model's stride) and the model's stride.
+    """
+    radius, stride = receptive_field(model)
+    return -(-radius // stride) * stride, stride
+
+
+def tile_size_for_budget(
+    budget_bytes: int,
+    *,
+    halo: int,
+    stride: int = 32,
+    bytes_per_pixel: int = RESNET50_BYTES_PER_PIXEL,
+) -> int:
+    """Calculates the largest tile core size fitting into a memory budget.
+
+    Args:
+        budget_bytes:  Memory available for a single backbone pass.
+        halo:  Overlap to add on each side of a tile.
+        stride:  Stride of the backbone.  The tile size will be a multiple of
+            it.
+        bytes_per_pixel:  Peak memory needed per (haloed) input pixel.
+
+    Returns:
+        The size of the non-overlapping part of each (square) tile.
+    """
+    side = int(np.sqrt(budget_bytes / bytes_per_pixel))
+    core = (side - 2 * halo) // stride * stride
+    if core < stride:
+        raise RuntimeError(
+            f"memory budget of {budget_bytes / 2**20:.0f} MiB is too small "
+            f"for tiled inference (need at least "
+            f"{(2 * halo + stride)**2 * bytes_per_pixel / 2**20:.0f} MiB)"
+        )
+    return core
+
+
+def iter_tiles(
+    shape: Tuple[int, int], tile_size: int
+) -> Iterator[Tuple[slice, slice]]:
+    """Yields the (non-overlapping) tile cores covering an image.
+
+    Yields:
+        The (row, column) slices of each tile core within the image.
+    """
+    height, width = shape
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield (
+                slice(row, min(height, row + tile_size)),
+                slice(col, min(width, col + tile_size)),
+            )
+
+
+def _with_halo(core: slice, halo: int, size: int) -> slice:
+    return slice(max(0, core.start - halo), min(size, core.stop + halo))
+
+
+def _shrink_to_needed(
+    core_rows: slice, core_cols: slice, needed: np.ndarray, stride: int
+) -> Optional[Tuple[slice, slice]]:
+    # shrinks a tile core to the bounding box of the features needed from it
+    feat_rows = _feature_slice(core_rows, 0, stride)
+    feat_cols = _feature_slice(core_cols, 0, stride)
+    tile_needed = needed[feat_rows, feat_cols]
+    if not tile_needed.any():
+        return None
+    needed_rows = np.flatnonzero(tile_needed.any(1))
+    needed_cols = np.flatnonzero(tile_needed.any(0))
+    return (
+        slice((feat_rows.start + needed_rows[0]) * stride,
+              min(core_rows.stop,
+                  (feat_rows.start + needed_rows[-1] + 1) * stride)),
+        slice((feat_cols.start + needed_cols[0]) * stride,
+              min(core_cols.stop,
+                  (feat_cols.start + needed_cols[-1] + 1) * stride)),
+    )
+
+
+def background_features(
+    model: nn.Module,
+    tfms: Callable[[np.ndarray], torch.Tensor],
+    like: np.ndarray,
+    *,
+    device: torch.device,
+    halo: int,
+    stride: int = 32,
+) -> torch.Tensor:
+    """Calculates the features of an empty (all-zero) region.
+
+    Args:
+        like:  Image whose channels / dtype the empty region should have.
+
+    Returns:
+        The (channels,) feature vector of a region which is empty across the
+        model's entire receptive field.
+    """
+    size = 2 * halo + stride
+    empty = np.zeros((size, size, *like.shape[2:]), dtype=like.dtype)
+    with torch.inference_mode():
+        res = model(tfms(empty).unsqueeze(0).to(device)).squeeze(0).cpu()
+    return res[:, halo // stride, halo // stride]
+
+
+def tiled_features(
+    model: nn.Module,
+    slide_array: np.ndarray,
+    tfms: Callable[[np.ndarray], torch.Tensor],
+    *,
+    device: torch.device,
+    tile_size: Optional[int] = None,
+    halo: Optional[int] = None,
+    stride: int = 32,
+    needed: Optional[np.ndarray] = None,
+    background: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Extracts a feature map from an image tile by tile.
+
+    Args:
+        model:  Fully convolutional backbone.
+        slide_array:  Image of shape (height, width[, channels]).
+        tfms:  Transforms turning a part of the image into a (C, H, W) tensor.
+        device:  Device to run the model on.
+        tile_size:  Size of the non-overlapping part of each tile.  Has to be
+            a multiple of `stride`.  If None, the whole image is processed in
+            one pass.
+        halo:  Overlap of the tiles.  Defaults to the model's receptive field
+            radius.
+        stride:  Stride of the model.
+        needed:  Boolean mask of the features to extract.  If given, only the
+            parts of tiles containing needed features are passed through the
+            model; all other features are set to `background`.
+        background:  Feature vector to fill features which are not needed
+            with (see `background_features`).
+
+    Returns:
+        The (channels, ceil(height/stride), ceil(width/stride)) feature map on
+        the CPU.  The (needed) features are identical (up to floating point
+        reordering) to the ones of a single pass.
+    """
+    height, width = slide_array.shape[:2]
+    if tile_size is None:
+        tile_size, halo = -(-max(height, width) // stride) * stride, 0
+    elif halo is None:
+        halo, stride = halo_for(model)
+    assert tile_size % stride == 0 and halo % stride == 0, \
+        f"tile size and halo have to be multiples of the stride ({stride})"
+
+    feats = None
+    if needed is not None:
+        assert background is not None, \
+            "a background has to be given when skipping features"
+        feats = background.view(-1, 1, 1).expand(
+            -1, -(-height // stride), -(-width // stride)
+        ).clone()
+
+    with torch.inference_mode():
+        for core_rows, core_cols in iter_tiles((height, width), tile_size):
+            if needed is not None:
+                if not (shrunk := _shrink_to_needed(
+                    core_rows, core_cols, needed, stride
+                )):
+                    continue
+                core_rows, core_cols = shrunk
+            rows = _with_halo(core_rows, halo, height)
+            cols = _with_halo(core_cols, halo, width)
+
+            x = tfms(slide_array[rows, cols])
+            res = model(x.unsqueeze(0).to(device)).squeeze(0).cpu()
+            if feats is None:
+                feats = torch.empty(
+                    res.shape[0],
+                    -(-height // stride),
+                    -(-width // stride),
+                    dtype=res.dtype,
+                )
+            # tiles and their cores start at multiples of the stride, so
+            # their feature maps are aligned with the one of the whole image
+            feats[
+                :,
+                _feature_slice(core_rows, 0, stride),
+                _feature_slice(core_cols, 0, stride),
+            ] = res[
+                :,
+                _feature_slice(core_rows, -rows.start, stride),
+                _feature_slice(core_cols, -cols.start, stride),
+            ]
+
+    assert feats is not None
+    return feats
+
+
+def _feature_slice(pixels: slice, offset: int, stride: int) -> slice:
+    # maps a slice of pixels to the slice of features they are the origin of
+    return slice(
+        (pixels.start + offset) // stride, -(-(pixels.stop + offset) // stride)
+    )
@@ -0,0 +1,76 @@
+"""Watching a directory for FOVs written by a live acquisition.
+
+Acquisition software writes FOVs over a while, so a file showing up does not
+mean it can be read yet.  Files are only considered complete once their size
+and modification time have not changed for a while.  The directory is polled
+(instead of relying on inotify & co.), so this also works for network shares.
+"""
+import fnmatch
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
+
+
+def watch_directory(
+    directory: Path,
+    pattern: str = "*",
+    *,
+    settle: float = 2.0,
+    poll_interval: float = 0.5,
+) -> Iterator[Path]:
+    """Yields the files in a directory as they are completed.
+
+    Files already in the directory are yielded as well.  Files which change
+    after having been yielded (e.g. as a FOV is acquired again) are yielded
+    again (note that cohort statistics keep a file's first version, see
+    `sketches.CohortStats.add_slide`).  Hidden files and `*.tmp` / `*.part`
+    files are ignored, as they are usually still being written.
+
+    Args:
+        pattern:  Glob pattern of the file names to yield.
+        settle:  Seconds a file's size and modification time have to stay the
+            same for the file to be considered complete.
+        poll_interval:  Seconds between polls of the directory.
+    """
+    # (size, modification time) of each file when it was last seen to change
+    # and when that was, and of the files already yielded
+    pending: Dict[Path, Tuple[Tuple[int, int], float]] = {}
+    done: Dict[Path, Tuple[int, int]] = {}
+    while True:
+        now = time.monotonic()
+        complete = []
+        with os.scandir(directory) as it:
+            entries = [
+                entry for entry in it
+                if entry.is_file()
+                and not entry.name.startswith(".")
+                and not entry.name.endswith((".tmp", ".part"))
+                and fnmatch.fnmatch(entry.name, pattern)
+            ]
+        for entry in entries:
+            path = Path(entry.path)
+            try:
+                stats = entry.stat()
+            except FileNotFoundError:
+                # (removed in the meantime)
+                continue
+            version = (stats.st_size, stats.st_mtime_ns)
+            if done.get(path) == version:
+                continue
+            if path not in pending or pending[path][0] != version:
+                pending[path] = (version, now)
+            elif now - pending[path][1] >= settle:
+                complete.append((stats.st_mtime_ns, path))
+                done[path] = version
+                del pending[path]
+        # (forget files which were removed)
+        present = {Path(entry.path) for entry in entries}
+        for files in (pending, done):
+            for path in files.keys() - present:
+                del files[path]
+
+        # oldest first, i.e. in the order they were acquired
+        for _, path in sorted(complete):
+            yield path
+        time.sleep(poll_interval)
@@ -0,0 +1,149 @@
+"""Creating a cohort's heatmaps in several processes, each on its own cores.
+
+PyTorch's operators scale poorly to many threads, least of all across
+sockets, so on large machines several processes using a few cores each get
+through a cohort of small slides a lot faster than one process using all of
+them.  The CPUs are split into disjoint sets, one per worker, keeping each
+set on one NUMA node (and the hyperthreads of a core together) where
+possible.  Each worker is a run of this script on a shard of the cohort (see
+`sharding`), pinned to its CPUs, so their statistics are merged just like
+those of shards run on different machines.
+"""
+import os
+import subprocess
+import time
+import warnings
+from functools import partial
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+
+def available_cpus() -> List[int]:
+    """Returns the CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _topology(cpu: int) -> Tuple[int, int, int]:
+    """Returns a CPU's NUMA node, socket and core (as far as known)."""
+    cpu_dir = Path(f"/sys/devices/system/cpu/cpu{cpu}")
+    node = next(
+        (
+            int(path.name[len("node"):])
+            for path in cpu_dir.glob("node[0-9]*")
+        ),
+        0,
+    )
+    try:
+        package = int(
+            (cpu_dir / "topology/physical_package_id").read_text()
+        )
+        core = int((cpu_dir / "topology/core_id").read_text())
+    except (OSError, ValueError):
+        package, core = 0, cpu
+    return node, package, core
+
+
+def partition_cpus(cpus: Sequence[int], n: int) -> List[List[int]]:
+    """Splits CPUs into `n` disjoint sets of (nearly) the same size.
+
+    The CPUs are ordered by NUMA node, socket and core before splitting them,
+    so the sets only span several nodes if the nodes' CPUs cannot be split
+    evenly, and hyperthreads of the same core end up in the same set.  If
+    there are fewer CPUs than sets, each set gets one CPU, shared with other
+    sets.
+    """
+    assert n > 0, "there has to be at least one worker."
+    ordered = sorted(cpus, key=lambda cpu: (*_topology(cpu), cpu))
+    if n > len(ordered):
+        warnings.warn(
+            f"only {len(ordered)} CPU(s) for {n} workers;  workers will share"
+            " CPUs"
+        )
+        return [[ordered[i % len(ordered)]] for i in range(n)]
+    sizes = [len(ordered) // n + (i < len(ordered) % n) for i in range(n)]
+    return [
+        ordered[sum(sizes[:i]):sum(sizes[:i + 1])] for i in range(n)
+    ]
+
+
+def run_workers(
+    argv: Sequence[str],
+    n_workers: int,
+    *,
+    shard_dir: Path,
+    shard: Optional[Tuple[int, int]] = None,
+    threads: Optional[int] = None,
+    stdin: Optional[bytes] = None,
+) -> int:
+    """Runs a command line of this script in worker processes.
+
+    Each worker runs on its own set of CPUs (see `partition_cpus`) and on
+    its own shard of the slides.  If a worker fails, the others are stopped
+    (as they would wait for its statistics forever).
+
+    Args:
+        argv:  The command line to run, which is extended by each worker's
+            `--shard`, `--shard-dir` and `--threads`.
+        shard_dir:  Directory to exchange the workers' statistics in.
+        shard:  The shard of the cohort the workers split between them, if
+            it is split across machines as well.  All machines have to run
+            the same number of workers.
+        threads:  Number of threads each worker runs operators with.
+            Defaults to the number of CPUs it runs on.
+        stdin:  Passed to each worker on its standard input (e.g.
+            credentials).  The workers cannot read the terminal's, as they
+            would all ask for input at the same time.
+
+    Returns:
+        The workers' exit status (that of the first to fail, if any).
+    """
+    rank, world_size = shard or (0, 1)
+    cpu_sets = partition_cpus(available_cpus(), n_workers)
+    workers: List[subprocess.Popen] = []
+    try:
+        for i, cpus in enumerate(cpu_sets):
+            worker_threads = threads or len(cpus)
+            print(f"Worker {i}: CPUs {cpus}, {worker_threads} thread(s)")
+            workers.append(subprocess.Popen(
+                [
+                    *argv,
+                    "--workers", "1",
+                    "--shard", f"{rank * n_workers + i}/"
+                    f"{world_size * n_workers}",
+                    "--shard-dir", str(shard_dir),
+                    "--threads", str(worker_threads),
+                ],
+                # (OpenMP & co. size their thread pools by these)
+                env={
+                    **os.environ,
+                    "OMP_NUM_THREADS": str(worker_threads),
+                    "MKL_NUM_THREADS": str(worker_threads),
+                },
+                preexec_fn=partial(os.sched_setaffinity, 0, cpus)
+                if hasattr(os, "sched_setaffinity") else None,
+                stdin=subprocess.DEVNULL if stdin is None
+                else subprocess.PIPE,
+            ))
+            if stdin is not None:
+                assert workers[-1].stdin is not None
+                workers[-1].stdin.write(stdin)
+                workers[-1].stdin.close()
+
+        running = list(workers)
+        while running:
+            for worker in list(running):
+                if (status := worker.poll()) is None:
+                    continue
+                running.remove(worker)
+                if status:
+                    return status
+            time.sleep(0.5)
+        return 0
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()